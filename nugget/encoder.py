@@ -11,23 +11,14 @@ class ExpressionEncoder(TreeEncoder):
     def __init__(self, atoms):
 
         n = len(atoms)
+        self.n_features = n + NON_ATOM_ENTRIES
+        self.atom_indices = {}
+        for (i, atom) in enumerate(atoms):
+            self.atom_indices[atom] = i + NON_ATOM_ENTRIES
 
         def value_fn(expr):
             value = torch.zeros(n + NON_ATOM_ENTRIES)
-            if expr.is_binary():
-                if expr.operator == PLUS:
-                    value[0] = 1
-                elif expr.operator == TIMES:
-                    value[1] = 1
-                else:
-                    raise ValueError("Unknown operator: " + str(expr.operator))
-            elif expr.is_focus():
-                value[2] = 1
-            elif expr.is_atom():
-                index = atoms.index(expr.identifier) + NON_ATOM_ENTRIES
-                value[index] = 1
-            else:
-                raise ValueError("Unknown expression: " + str(expr))
+            value[self.index(expr)] = 1
             return value
 
         def children_fn(expr):
@@ -35,3 +26,94 @@ class ExpressionEncoder(TreeEncoder):
 
         super(ExpressionEncoder, self).__init__(value_fn, children_fn)
 
+    def index(self, expr):
+        """Return the index of the feature set in the encoding of a node."""
+
+        if expr.is_binary():
+            if expr.operator == PLUS:
+                return 0
+            elif expr.operator == TIMES:
+                return 1
+            else:
+                raise ValueError("Unknown operator: " + str(expr.operator))
+        elif expr.is_focus():
+            return 2
+        elif expr.is_atom():
+            try:
+                return self.atom_indices[expr.identifier]
+            except KeyError:
+                raise ValueError("Unknown atom: " + str(expr.identifier))
+        else:
+            raise ValueError("Unknown expression: " + str(expr))
+
+    def encode_indices(self, trees):
+        """Encodes a sequence of expressions as feature indices.
+
+        Args:
+            trees: A sequence of expressions.
+
+        Returns:
+            (list, list, int): The flat lists of feature indices and of
+            arities, in the layout of `encode_batch` with the temporal
+            dimension first, and the largest number of nodes in the trees.
+            Padding entries have index and arity ``-1``.
+        """
+
+        all_indices = []
+        all_arities = []
+        max_size = 0
+        for tree in trees:
+            # Pre-order, visiting left children first, is the reverse of
+            # the right-first post-order expected by treenet.
+            indices = []
+            arities = []
+            stack = [tree]
+            while stack:
+                expr = stack.pop()
+                children = expr.get_children()
+                indices.append(self.index(expr))
+                arities.append(len(children))
+                stack.extend(reversed(children))
+            indices.reverse()
+            arities.reverse()
+            all_indices.append(indices)
+            all_arities.append(arities)
+            max_size = max(max_size, len(indices))
+
+        batch_size = len(all_indices)
+        flat_indices = [-1] * (max_size * batch_size)
+        flat_arities = [-1] * (max_size * batch_size)
+        for (j, (indices, arities)) in enumerate(zip(all_indices, all_arities)):
+            end = len(indices) * batch_size
+            flat_indices[j:end:batch_size] = indices
+            flat_arities[j:end:batch_size] = arities
+        return (flat_indices, flat_arities, max_size)
+
+    def encode_batch(self, trees, batch_first=False, ignore_value=None):
+        """Encodes a sequence of expressions.
+
+        Produces the same tensors as `TreeEncoder.encode_batch`,
+        but builds all one-hot vectors at once from their indices.
+        """
+
+        (indices, arities, max_size) = self.encode_indices(trees)
+        batch_size = len(trees)
+
+        table = torch.cat([torch.eye(self.n_features),
+                           torch.zeros(1, self.n_features)])
+        if ignore_value is not None:
+            if type(ignore_value) is list or type(ignore_value) is tuple:
+                ignore_value = torch.FloatTensor(ignore_value)
+            table[self.n_features] = ignore_value
+
+        # Padding entries select the last row of the table.
+        indices = torch.LongTensor(
+            [i if i >= 0 else self.n_features for i in indices])
+        values = table.index_select(0, indices).view(
+            max_size, batch_size, self.n_features)
+        arities = torch.LongTensor(arities).view(max_size, batch_size)
+
+        if batch_first:
+            values = values.transpose(0, 1).contiguous()
+            arities = arities.transpose(0, 1).contiguous()
+        return values, arities
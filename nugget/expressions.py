@@ -1,5 +1,7 @@
 # Copyright 2018 EPFL.
 
+import weakref
+
 # Binary operators.
 TIMES = "*"
 PLUS = "+"
@@ -53,31 +55,123 @@ def from_prefix_notation(string):
         Expression: The parsed expression.
     """
 
-    def parse(tokens):
-        head = tokens[0]
-        if head in [PLUS, TIMES]:
-            (lhs, rest) = parse(tokens[1:])
-            (rhs, remaining) = parse(rest)
-            return (Binary(head, lhs, rhs), remaining)
-        elif head == FOCUS_MARKER:
-            (expr, rest) = parse(tokens[1:])
-            return (Focus(expr), rest)
+    # Tokens are processed from the last one, so that the operands
+    # of each operator are already parsed when the operator is reached.
+    stack = []
+    for token in reversed(string.split()):
+        if token == PLUS or token == TIMES:
+            if len(stack) < 2:
+                break
+            lhs = stack.pop()
+            rhs = stack.pop()
+            stack.append(Binary(token, lhs, rhs))
+        elif token == FOCUS_MARKER:
+            if not stack:
+                break
+            stack.append(Focus(stack.pop()))
+        else:
+            stack.append(Atom(token))
+    else:
+        if len(stack) == 1:
+            return stack[0]
+
+    raise ValueError("Impossible to parse {}".format(str(string)))
+
+
+def to_prefix_notation(expr):
+    """Return the prefix notation of an expression.
+
+    Args:
+        expr (Expression): An expression.
+
+    Returns:
+        string: The prefix notation of the expression.
+    """
+
+    tokens = []
+    stack = [expr]
+    while stack:
+        current = stack.pop()
+        if current.is_binary():
+            tokens.append(current.operator)
+            stack.append(current.rhs)
+            stack.append(current.lhs)
+        elif current.is_focus():
+            tokens.append(FOCUS_MARKER)
+            stack.append(current.expr)
         else:
-            return (Atom(head), tokens[1:])
+            tokens.append(current.identifier)
+    return " ".join(tokens)
+
+
+def to_infix_notation(expr):
+    """Return the fully parenthesized infix notation of an expression.
+
+    Args:
+        expr (Expression): An expression.
 
-    (parsed, rest) = parse(string.split())
-    if rest:
-        raise ValueError("Impossible to parse {}".format(str(string)))
-    return parsed
+    Returns:
+        string: The infix notation of the expression,
+        with the focus between square brackets.
+    """
+
+    parts = []
+    stack = [expr]
+    while stack:
+        current = stack.pop()
+        if isinstance(current, str):
+            parts.append(current)
+        elif current.is_binary():
+            parts.append("(")
+            stack.append(")")
+            stack.append(current.rhs)
+            stack.append(" {} ".format(current.operator))
+            stack.append(current.lhs)
+        elif current.is_focus():
+            parts.append("[")
+            stack.append("]")
+            stack.append(current.expr)
+        else:
+            parts.append(str(current.identifier))
+    return "".join(parts)
 
 
 
 class Expr(object):
-    """Simple mathematical expression, possibly with a focus."""
+    """Simple mathematical expression, possibly with a focus.
+
+    Expressions are immutable and hash-consed: structurally equal
+    expressions are represented by a single shared object. Equality is
+    therefore identity, and the hash, height and length of each node are
+    computed once, at construction.
+    """
+
+    __slots__ = ()
 
     def __lt__(self, other):
         return False
 
+    def __setattr__(self, name, value):
+        raise AttributeError("Expressions are immutable.")
+
+    def __delattr__(self, name):
+        raise AttributeError("Expressions are immutable.")
+
+    def __eq__(self, that):
+        return self is that
+
+    def __ne__(self, that):
+        return self is not that
+
+    def __hash__(self):
+        return self._hash
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
     def to_prefix_notation(self):
         return ""
 
@@ -133,37 +227,41 @@ class Expr(object):
 class Binary(Expr):
     """Binary operation."""
 
-    def __init__(self, operator, lhs, rhs):
-        self.operator = operator
-        self.lhs = lhs
-        self.rhs = rhs
+    __slots__ = ('operator', 'lhs', 'rhs',
+                 '_hash', '_height', '_length', '__weakref__')
+
+    _instances = weakref.WeakValueDictionary()
+
+    def __new__(cls, operator, lhs, rhs):
+        key = (operator, lhs, rhs)
+        self = cls._instances.get(key)
+        if self is None:
+            self = object.__new__(cls)
+            init = object.__setattr__
+            init(self, 'operator', operator)
+            init(self, 'lhs', lhs)
+            init(self, 'rhs', rhs)
+            init(self, '_hash', hash(("Binary", operator, lhs, rhs)))
+            init(self, '_height', 1 + max(lhs._height, rhs._height))
+            init(self, '_length', 1 + lhs._length + rhs._length)
+            self = cls._instances.setdefault(key, self)
+        return self
+
+    def __reduce__(self):
+        return (Binary, (self.operator, self.lhs, self.rhs))
 
     def __str__(self):
-        return "({} {} {})".format(self.lhs, self.operator, self.rhs)
+        return to_infix_notation(self)
 
     def __repr__(self):
-        return "({} {} {})".format(self.lhs, self.operator, self.rhs)
+        return to_infix_notation(self)
 
     def to_prefix_notation(self):
-        return "{} {} {}".format(self.operator,
-            self.lhs.to_prefix_notation(), self.rhs.to_prefix_notation())
+        return to_prefix_notation(self)
 
     def is_binary(self):
         return True
 
-    def __eq__(self, that):
-        if not isinstance(that, Binary):
-            return False
-        return (self.operator == that.operator and
-                self.lhs == that.lhs and
-                self.rhs == that.rhs)
-
-    def __ne__(self, that):
-        return not (self == that)
-
-    def __hash__(self):
-        return hash(("Binary", self.operator, self.lhs, self.rhs))
-
     def move_focus_up(self):
         if (self.lhs.is_focus()):
             return Focus(Binary(self.operator, self.lhs.expr, self.rhs))
@@ -281,17 +379,33 @@ class Binary(Expr):
         return [self.lhs, self.rhs]
 
     def height(self):
-        return 1 + max(self.lhs.height(), self.rhs.height())
+        return self._height
 
     def length(self):
-        return 1 + self.lhs.length() + self.rhs.length()
+        return self._length
 
 
 class Atom(Expr):
     """Variable."""
 
-    def __init__(self, identifier):
-        self.identifier = identifier
+    __slots__ = ('identifier', '_hash', '_height', '_length', '__weakref__')
+
+    _instances = weakref.WeakValueDictionary()
+
+    def __new__(cls, identifier):
+        self = cls._instances.get(identifier)
+        if self is None:
+            self = object.__new__(cls)
+            init = object.__setattr__
+            init(self, 'identifier', identifier)
+            init(self, '_hash', hash(("Atom", identifier)))
+            init(self, '_height', 0)
+            init(self, '_length', 1)
+            self = cls._instances.setdefault(identifier, self)
+        return self
+
+    def __reduce__(self):
+        return (Atom, (self.identifier,))
 
     def __str__(self):
         return str(self.identifier)
@@ -302,52 +416,46 @@ class Atom(Expr):
     def to_prefix_notation(self):
         return self.identifier
 
-    def __eq__(self, other):
-        if not isinstance(other, Atom):
-            return False
-        return self.identifier == other.identifier
-
-    def __ne__(self, that):
-        return not (self == that)
-
-    def __hash__(self):
-        return hash(("Atom", self.identifier))
-
     def is_atom(self):
         return True
 
     def height(self):
-        return 0
+        return self._height
 
     def length(self):
-        return 1
+        return self._length
 
 
 class Focus(Expr):
     """Focused expression."""
 
-    def __init__(self, expr):
-        self.expr = expr
+    __slots__ = ('expr', '_hash', '_height', '_length', '__weakref__')
 
-    def __str__(self):
-        return "[{}]".format(self.expr)
+    _instances = weakref.WeakValueDictionary()
 
-    def __repr__(self):
-        return "[{}]".format(self.expr)
+    def __new__(cls, expr):
+        self = cls._instances.get(expr)
+        if self is None:
+            self = object.__new__(cls)
+            init = object.__setattr__
+            init(self, 'expr', expr)
+            init(self, '_hash', hash((FOCUS_MARKER, expr)))
+            init(self, '_height', 1 + expr._height)
+            init(self, '_length', 1 + expr._length)
+            self = cls._instances.setdefault(expr, self)
+        return self
 
-    def to_prefix_notation(self):
-        return "{} {}".format(FOCUS_MARKER, self.expr.to_prefix_notation())
+    def __reduce__(self):
+        return (Focus, (self.expr,))
 
-    def __eq__(self, other):
-        if not isinstance(other, Focus):
-            return False
-        return self.expr == other.expr
+    def __str__(self):
+        return to_infix_notation(self)
 
-    def __ne__(self, that):
-        return not (self == that)
+    def __repr__(self):
+        return to_infix_notation(self)
 
-    def __hash__(self):
-        return hash((FOCUS_MARKER, self.expr))
+    def to_prefix_notation(self):
+        return to_prefix_notation(self)
 
     def is_focus(self):
         return True
@@ -367,61 +475,24 @@ class Focus(Expr):
         return Binary(self.expr.operator, self.expr.lhs, Focus(self.expr.rhs))
 
     def apply_commutativity(self):
-
-        if not self.expr.is_binary():
-            return None
-
-        return Focus(Binary(self.expr.operator, self.expr.rhs, self.expr.lhs))
+        expr = commutativity(self.expr)
+        return Focus(expr) if expr is not None else None
 
     def apply_associativity_left(self):
-
-        if not (self.expr.is_binary() and
-                self.expr.lhs.is_binary() and
-                self.expr.operator == self.expr.lhs.operator):
-            return None
-
-        return Focus(Binary(
-            self.expr.operator,
-            self.expr.lhs.lhs,
-            Binary(self.expr.operator, self.expr.lhs.rhs, self.expr.rhs)))
+        expr = associativity_left(self.expr)
+        return Focus(expr) if expr is not None else None
 
     def apply_associativity_right(self):
-
-        if not (self.expr.is_binary() and
-                self.expr.rhs.is_binary() and
-                self.expr.operator == self.expr.rhs.operator):
-            return None
-
-        return Focus(Binary(
-            self.expr.operator,
-            Binary(self.expr.operator, self.expr.lhs, self.expr.rhs.lhs),
-            self.expr.rhs.rhs))
+        expr = associativity_right(self.expr)
+        return Focus(expr) if expr is not None else None
 
     def apply_distributivity_times(self):
-        if not (self.expr.is_binary() and
-                self.expr.rhs.is_binary() and
-                self.expr.operator == TIMES and
-                self.expr.rhs.operator == PLUS):
-            return None
-        a = self.expr.lhs
-        b = self.expr.rhs.lhs
-        c = self.expr.rhs.rhs
-        return Focus(Binary(PLUS, Binary(TIMES, a, b), Binary(TIMES, a, c)))
+        expr = distributivity_times(self.expr)
+        return Focus(expr) if expr is not None else None
 
     def apply_distributivity_plus(self):
-        if not (self.expr.is_binary() and
-                self.expr.lhs.is_binary() and
-                self.expr.rhs.is_binary() and
-                self.expr.operator == PLUS and
-                self.expr.lhs.operator == TIMES and
-                self.expr.rhs.operator == TIMES and
-                self.expr.lhs.lhs == self.expr.rhs.lhs):
-            return None
-
-        a = self.expr.lhs.lhs
-        b = self.expr.lhs.rhs
-        c = self.expr.rhs.rhs
-        return Focus(Binary(TIMES, a, Binary(PLUS, b, c)))
+        expr = distributivity_plus(self.expr)
+        return Focus(expr) if expr is not None else None
 
     def remove_focus(self):
         return self.expr
@@ -433,8 +504,113 @@ class Focus(Expr):
         return [self.expr]
 
     def height(self):
-        return 1 + self.expr.height()
+        return self._height
 
     def length(self):
-        return 1 + self.expr.length()
+        return self._length
+
+
+def commutativity(expr):
+    """Apply commutativity at the root of an expression without focus.
+
+    Returns:
+        Expression: The rewritten expression, or None if not applicable.
+    """
+
+    if not expr.is_binary():
+        return None
+
+    return Binary(expr.operator, expr.rhs, expr.lhs)
+
+
+def associativity_left(expr):
+    """Apply left associativity at the root of an expression without focus.
+
+    Returns:
+        Expression: The rewritten expression, or None if not applicable.
+    """
+
+    if not (expr.is_binary() and
+            expr.lhs.is_binary() and
+            expr.operator == expr.lhs.operator):
+        return None
+
+    return Binary(
+        expr.operator,
+        expr.lhs.lhs,
+        Binary(expr.operator, expr.lhs.rhs, expr.rhs))
+
+
+def associativity_right(expr):
+    """Apply right associativity at the root of an expression without focus.
+
+    Returns:
+        Expression: The rewritten expression, or None if not applicable.
+    """
+
+    if not (expr.is_binary() and
+            expr.rhs.is_binary() and
+            expr.operator == expr.rhs.operator):
+        return None
+
+    return Binary(
+        expr.operator,
+        Binary(expr.operator, expr.lhs, expr.rhs.lhs),
+        expr.rhs.rhs)
+
+
+def distributivity_times(expr):
+    """Distribute a product over a sum, at the root of an expression.
+
+    Returns:
+        Expression: The rewritten expression, or None if not applicable.
+    """
+
+    if not (expr.is_binary() and
+            expr.rhs.is_binary() and
+            expr.operator == TIMES and
+            expr.rhs.operator == PLUS):
+        return None
+    a = expr.lhs
+    b = expr.rhs.lhs
+    c = expr.rhs.rhs
+    return Binary(PLUS, Binary(TIMES, a, b), Binary(TIMES, a, c))
+
+
+def distributivity_plus(expr):
+    """Factor a sum of products, at the root of an expression.
+
+    Returns:
+        Expression: The rewritten expression, or None if not applicable.
+    """
+
+    if not (expr.is_binary() and
+            expr.lhs.is_binary() and
+            expr.rhs.is_binary() and
+            expr.operator == PLUS and
+            expr.lhs.operator == TIMES and
+            expr.rhs.operator == TIMES and
+            expr.lhs.lhs == expr.rhs.lhs):
+        return None
 
+    a = expr.lhs.lhs
+    b = expr.lhs.rhs
+    c = expr.rhs.rhs
+    return Binary(TIMES, a, Binary(PLUS, b, c))
+
+
+# Rewrite rules applied at the focus, in the order of `transformations`.
+rewrites = [
+    (ASSOC_LEFT, associativity_left),
+    (ASSOC_RIGHT, associativity_right),
+    (COMMU, commutativity),
+    (DISTRI_TIMES, distributivity_times),
+    (DISTRI_PLUS, distributivity_plus)]
+
+# Rewrite rule undoing each rewrite rule.
+inverse_rewrites = {
+    ASSOC_LEFT: ASSOC_RIGHT,
+    ASSOC_RIGHT: ASSOC_LEFT,
+    COMMU: COMMU,
+    DISTRI_TIMES: DISTRI_PLUS,
+    DISTRI_PLUS: DISTRI_TIMES}
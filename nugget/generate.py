@@ -4,6 +4,7 @@ import argparse
 import random
 
 from nugget.expressions import *
+from nugget.zipper import expand
 
 
 def random_expr(depth, atoms):
@@ -185,11 +186,9 @@ def random_transformations(start, length):
         focus.extend(dirs[:nDown])
 
         # Apply transformation.
-        neighbors = [current.apply_commutativity(),
-                     current.apply_associativity_left(),
-                     current.apply_associativity_right(),
-                     current.apply_distributivity_times(),
-                     current.apply_distributivity_plus()]
+        successors = dict(expand(current)[0])
+        neighbors = [successors.get(t) for t in
+                     [COMMU, ASSOC_LEFT, ASSOC_RIGHT, DISTRI_TIMES, DISTRI_PLUS]]
         neighbors = [n for n in neighbors if n is not None]
         current = random.choice(neighbors)
 
@@ -296,10 +295,11 @@ def explore(from_expr, max_depth, including=None):
 
         next_depth = current_depth + 1
 
+        successors = dict(expand(current_expr)[0])
         ts = transformations[:]
         random.shuffle(ts)
         for t in ts:
-            next_expr = transformations_functions[t](current_expr)
+            next_expr = successors.get(t)
             if (next_expr is not None and
                     ((not next_expr in seen) or seen[next_expr] == next_depth)):
                 seen[next_expr] = next_depth
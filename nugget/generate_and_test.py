@@ -1,12 +1,18 @@
 import argparse
+import functools
 import os
 import random
+import sys
 from timeit import default_timer
 
 from nugget.generate import random_pair
 from nugget.heuristics import *
+from nugget.history import NullHistory, open_history
+from nugget.inference import NumpyHeuristics
+from nugget.openlist import BucketOpenList, HeapOpenList
+from nugget.packed import Codec
 from nugget.search import *
-from nugget.utils import timeout
+from nugget.utils import BatchSizeTuner, Budget, SearchStats
 
 DEFAULT_LOGS_DIR = "logs/"
 DEFAULT_ATOMS = list("abc")
@@ -34,11 +40,29 @@ if __name__ == "__main__":
     parser.add_argument("-d", "--distance", type=int,
         help="approximate distance for the generated expressions",
         default=DEFAULT_APPROX_DISTANCE)
-    parser.add_argument("--timeout", type=int,
+    parser.add_argument("--timeout", type=float,
         help="timeout for the search, in seconds",
         default=DEFAULT_TIMEOUT)
+    parser.add_argument("--max-expansions", type=int,
+        help="maximal number of states expanded by each search")
+    parser.add_argument("--max-visited", type=int,
+        help="maximal number of states visited by each search")
+    parser.add_argument("--stats", type=str,
+        help="file to which the measurements of each search are written")
+    parser.add_argument("--stats-format", choices=["csv", "json"],
+        help="format of the measurements, with --stats",
+        default="csv")
     parser.add_argument("--no-logs", action="store_true",
         help="disable logging of search history")
+    parser.add_argument("--log-format", choices=["csv", "packed"],
+        help="format of the history logs",
+        default="csv")
+    parser.add_argument("--packed", action="store_true",
+        help="store the visited states in packed form")
+    parser.add_argument("--bidirectional", action="store_true",
+        help="use bidirectional search for BFS")
+    parser.add_argument("--bidirectional-nngs", action="store_true",
+        help="use bidirectional search for NNGS")
     parser.add_argument("-a", "--atoms", nargs="+", type=str,
         help="atoms",
         default=DEFAULT_ATOMS)
@@ -54,20 +78,116 @@ if __name__ == "__main__":
     parser.add_argument("-b", "--batch", help="batch size", type=int,
         default=DEFAULT_BATCH_SIZE)
     parser.add_argument("--no-cuda", help="disable CUDA", action="store_true")
+    parser.add_argument("--memoize", type=int,
+        help="number of heuristic estimates to remember across problems")
+    parser.add_argument("--memo-file", type=str,
+        help="file storing the remembered estimates between runs")
+    parser.add_argument("--batch-children", action="store_true",
+        help="estimate all successors of a state at once in NNGS")
+    parser.add_argument("--pipelined", action="store_true",
+        help="estimate batches in a background thread in Batch-NNGS")
+    parser.add_argument("--auto-batch", action="store_true",
+        help="choose the batch size of Batch-NNGS from measured latencies")
+    parser.add_argument("--max-latency", type=float,
+        help="maximal time in seconds to estimate a batch, with --auto-batch")
+    parser.add_argument("--buckets", type=float,
+        help="keep the open lists of NNGS in buckets of that width")
+    parser.add_argument("--lifo", action="store_true",
+        help="pop the most recent entry of a bucket first, with --buckets")
+    parser.add_argument("--numpy", action="store_true",
+        help="evaluate the network on CPU with NumPy for single queries")
     parser.add_argument("--device", type=int, help="GPU device")
     parser.add_argument("-s", "--size", help="embedding size", type=int)
+    parser.add_argument("--cache", type=int,
+        help="number of subexpression embeddings to cache")
 
     args = parser.parse_args()
 
-    h = Heuristics(args.atoms, args.model, args.size)
+    if args.numpy and args.bidirectional_nngs:
+        parser.error("--numpy does not support bidirectional NNGS")
+    if args.batch_children and args.bidirectional_nngs:
+        parser.error("--batch-children does not support bidirectional NNGS")
+    if args.buckets is not None and args.bidirectional_nngs:
+        parser.error("--buckets does not support bidirectional NNGS")
+
+    if args.numpy:
+        h = NumpyHeuristics(args.atoms, args.model, args.size, args.cache)
+    else:
+        h = Heuristics(args.atoms, args.model, args.size, args.cache)
     cuda = not args.no_cuda and torch.cuda.is_available()
     if cuda:
-        h_batch = Heuristics(args.atoms, args.model, args.size)
+        h_batch = Heuristics(args.atoms, args.model, args.size, args.cache)
         h_batch.cuda(args.device)
         # We do not send h to CUDA, much slower on single queries.
     else:
         h_batch = h
 
+    codec = Codec(args.atoms) if args.packed else None
+
+    if args.buckets is not None:
+        open_list = functools.partial(BucketOpenList, args.buckets,
+            lifo=args.lifo)
+    else:
+        open_list = HeapOpenList
+
+    if args.memoize is not None:
+        memoized = MemoizedHeuristics(h, args.memoize, args.memo_file, codec)
+        if h_batch is h:
+            h_batch = memoized
+        else:
+            h_batch = MemoizedHeuristics(h_batch, args.memoize, codec=codec)
+        h = memoized
+
+    if args.bidirectional:
+        bfs = bidirectional_breadth_first_search
+    else:
+        bfs = breadth_first_search
+
+    if args.bidirectional_nngs:
+        nngs = bidirectional_best_first_search
+    else:
+        nngs = functools.partial(best_first_search,
+            batch_children=args.batch_children, open_list=open_list)
+
+    if args.pipelined:
+        batch_nngs = pipelined_batch_best_first_search
+    else:
+        batch_nngs = batch_best_first_search
+
+    if args.auto_batch:
+        tuner = BatchSizeTuner(max_latency=args.max_latency)
+    else:
+        tuner = None
+
+    # Each search gets a fresh budget.
+    budget = functools.partial(Budget, args.timeout,
+        expansions=args.max_expansions, visited=args.max_visited)
+
+    if args.stats is not None:
+        statsFile = open(args.stats, 'w')
+        if args.stats_format == "csv":
+            statsFile.write(SearchStats.csv_header(["id", "search"]) + "\n")
+
+    def new_stats():
+        return SearchStats() if args.stats is not None else None
+
+    def write_stats(stats, i, search):
+        if stats is None:
+            return
+        if args.stats_format == "csv":
+            statsFile.write(stats.to_csv([i, search]) + "\n")
+        else:
+            statsFile.write(stats.to_json(id=i, search=search) + "\n")
+
+    # Histories are streamed to the logs during the searches.
+    log_codec = codec if codec is not None else Codec(args.atoms)
+
+    def new_history(i, search):
+        if args.no_logs:
+            return NullHistory()
+        return open_history(os.path.join(args.log_dir,
+            "{}-{}".format(i, search)), args.log_format, log_codec)
+
     i = 0
 
     print(",".join([
@@ -92,58 +212,44 @@ if __name__ == "__main__":
         if a == b:
             continue
 
-        def exp0():
-            start_time = default_timer()
-            (p0, a0, h0) = breadth_first_search(a, b)
-            end_time = default_timer()
-            d0 = end_time - start_time
-            return (p0, a0, h0, d0)
-
-        res0 = timeout(exp0, args.timeout)
-        if res0 is not None:
-            (p0, a0, h0, d0) = res0
-
-        if res0 is not None and not args.no_logs:
-            outputFile = open(os.path.join(args.log_dir,
-                "{}-bfs.csv".format(i)), 'w')
-            outputFile.write(history_to_csv(h0))
-            outputFile.close()
-
-
-        def exp1():
-            start_time = default_timer()
-            (p1, a1, h1) = best_first_search(a, b, h, args.penalty)
-            end_time = default_timer()
-            d1 = end_time - start_time
-            return (p1, a1, h1, d1)
-
-        res1 = timeout(exp1, args.timeout)
-        if res1 is not None:
-            (p1, a1, h1, d1) = res1
-
-        if res1 is not None and not args.no_logs:
-            outputFile = open(os.path.join(args.log_dir,
-                "{}-nngs.csv".format(i)), 'w')
-            outputFile.write(history_to_csv(h1))
-            outputFile.close()
-
-        def exp2():
-            start_time = default_timer()
-            (p2, a2, h2) = batch_best_first_search(a, b,
-                h_batch, args.penalty, args.batch)
-            end_time = default_timer()
-            d2 = end_time - start_time
-            return (p2, a2, h2, d2)
-
-        res2 = timeout(exp2, args.timeout)
-        if res2 is not None:
-            (p2, a2, h2, d2) = res2
-
-        if res2 is not None and not args.no_logs:
-            outputFile = open(os.path.join(args.log_dir,
-                "{}-batch-nngs.csv".format(i)), 'w')
-            outputFile.write(history_to_csv(h2))
-            outputFile.close()
+        stats = new_stats()
+        history = new_history(i, "bfs")
+        start_time = default_timer()
+        res0 = bfs(a, b, codec=codec, budget=budget(), stats=stats,
+            history=history)
+        end_time = default_timer()
+        d0 = end_time - start_time
+        write_stats(stats, i, "bfs")
+        # Only the logs of the searches reaching the target are kept.
+        history.close(keep=bool(res0))
+        if res0:
+            (p0, a0, h0) = res0
+
+        stats = new_stats()
+        history = new_history(i, "nngs")
+        start_time = default_timer()
+        res1 = nngs(a, b, h, args.penalty,
+            codec=codec, budget=budget(), stats=stats, history=history)
+        end_time = default_timer()
+        d1 = end_time - start_time
+        write_stats(stats, i, "nngs")
+        history.close(keep=bool(res1))
+        if res1:
+            (p1, a1, h1) = res1
+
+        stats = new_stats()
+        history = new_history(i, "batch-nngs")
+        start_time = default_timer()
+        res2 = batch_nngs(a, b,
+            h_batch, args.penalty, args.batch, codec=codec, tuner=tuner,
+            open_list=open_list, budget=budget(), stats=stats,
+            history=history)
+        end_time = default_timer()
+        d2 = end_time - start_time
+        write_stats(stats, i, "batch-nngs")
+        history.close(keep=bool(res2))
+        if res2:
+            (p2, a2, h2) = res2
 
         print(','.join([
             str(i),
@@ -159,4 +265,17 @@ if __name__ == "__main__":
             str(len(h2)) if res2 else "",
             str(d2) if res2 else ""]))
 
-        i += 1
\ No newline at end of file
+        i += 1
+
+    if args.stats is not None:
+        statsFile.close()
+
+    if args.memoize is not None and args.memo_file is not None:
+        h.save()
+
+    if tuner is not None:
+        if tuner.chosen is not None:
+            sys.stderr.write("Chosen batch size: {}\n".format(tuner.chosen))
+        else:
+            sys.stderr.write("Batch size not chosen yet, last tried: {}\n"
+                .format(tuner.batch_size()))
\ No newline at end of file
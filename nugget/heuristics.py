@@ -1,13 +1,34 @@
 # Copyright 2018 EPFL.
 
+import os
+import pickle
+from timeit import default_timer
+
 import torch
 
 from nugget.encoder import ExpressionEncoder
 from nugget.network import Net
+from nugget.utils import LRUCache
 
 class Heuristics(object):
+    """Distance and transformation estimates from a trained model.
+
+    The `with_target` family of methods, as well as `embed`, accept
+    a SearchStats, in which the time spent encoding the expressions
+    and evaluating the network is then recorded. On GPU, the operations
+    are asynchronous, so that their time may be attributed to the next
+    synchronizing operation.
+
+    Args:
+        atoms: Available atoms.
+        model: File of the trained model.
+        embedding_size: Embedding size of the model.
+        cache_size: If given, the TreeLSTM states of up to that many
+            subexpressions are cached, so that only subexpressions
+            absent from the cache are fed to the network.
+    """
 
-    def __init__(self, atoms, model, embedding_size=None):
+    def __init__(self, atoms, model, embedding_size=None, cache_size=None):
         if embedding_size is not None:
             self.model = Net(len(atoms), embedding_size)
         else:
@@ -18,41 +39,195 @@ class Heuristics(object):
         self.is_cuda = False
         self.device = None
 
+        self.cache = LRUCache(cache_size) if cache_size is not None else None
+        self.inputs = torch.eye(self.encoder.n_features)
+
     def cuda(self, device=None):
         self.is_cuda = True
         self.device = device
         self.model.cuda(device)
+        self.inputs = self.inputs.cuda(device)
+        if self.cache is not None:
+            self.cache.clear()
+
+    def embed(self, exprs, stats=None):
+        """Compute the embeddings of a list of expressions."""
+
+        if self.cache is not None:
+            return self.embed_incremental(exprs, stats)
 
-    def with_target_batch(self, target):
-        e2s, a2s = self.encoder.encode_batch([target])
-        e2s = torch.autograd.Variable(e2s)
+        if stats is not None:
+            start_time = default_timer()
+        es, as_ = self.encoder.encode_batch(exprs)
+        es = torch.autograd.Variable(es)
         if self.is_cuda:
-            e2s = e2s.cuda(self.device)
-            a2s = a2s.cuda(self.device)
-        target_embeddings = self.model.embeddings(e2s, a2s)
+            es = es.cuda(self.device)
+            as_ = as_.cuda(self.device)
+        if stats is not None:
+            encoded_time = default_timer()
+            stats.add_time('encoding', encoded_time - start_time)
+        embeddings = self.model.embeddings(es, as_)
+        if stats is not None:
+            stats.add_time('model', default_timer() - encoded_time)
+        return embeddings
 
-        def apply(source):
-            e1s, a1s = self.encoder.encode_batch(source)
-            e1s = torch.autograd.Variable(e1s)
+    def embed_incremental(self, exprs, stats=None):
+        """Compute the embeddings of expressions, reusing cached subtrees.
+
+        Subexpressions missing from the cache are fed to the TreeLSTM unit
+        level by level, all nodes of the same height at once. Their states
+        are then cached, keyed by the (interned) subexpression.
+        """
+
+        if stats is not None:
+            start_time = default_timer()
+            model_time = 0.0
+
+        unit = self.model.treelstm.unit
+        branching_factor = self.model.treelstm.branching_factor
+        state_size = self.model.treelstm.output_size
+
+        # Finding the states already available, and the missing nodes.
+        states = {}
+        missing = {}
+        stack = list(exprs)
+        while stack:
+            expr = stack.pop()
+            if expr in states or expr in missing:
+                continue
+            state = self.cache.get(expr)
+            if state is not None:
+                states[expr] = state
+            else:
+                missing[expr] = None
+                stack.extend(expr.get_children())
+
+        levels = {}
+        for expr in missing:
+            levels.setdefault(expr.height(), []).append(expr)
+
+        zeros = torch.autograd.Variable(
+            self.inputs.new(state_size).fill_(0))
+        for height in sorted(levels):
+            nodes = levels[height]
+            indices = torch.LongTensor(
+                [self.encoder.index(expr) for expr in nodes])
+            arities = torch.LongTensor(
+                [len(expr.get_children()) for expr in nodes])
             if self.is_cuda:
-                e1s = e1s.cuda(self.device)
-                a1s = a1s.cuda(self.device)
-            source_embeddings = self.model.embeddings(e1s, a1s)
+                indices = indices.cuda(self.device)
+                arities = arities.cuda(self.device)
+            inputs = torch.autograd.Variable(
+                self.inputs.index_select(0, indices))
+
+            children = []
+            for k in range(branching_factor):
+                children.append(torch.stack([
+                    states[expr.get_children()[k]]
+                    if k < len(expr.get_children()) else zeros
+                    for expr in nodes]))
+
+            if stats is not None:
+                unit_time = default_timer()
+            outputs = unit(inputs, children, arities).detach()
+            if stats is not None:
+                model_time += default_timer() - unit_time
+            for (expr, state) in zip(nodes, outputs):
+                states[expr] = state
+                self.cache.put(expr, state)
+
+        roots = torch.stack([states[expr] for expr in exprs])
+        if stats is not None:
+            stats.add_time('model', model_time)
+            stats.add_time('encoding',
+                default_timer() - start_time - model_time)
+        return torch.chunk(roots, 2, dim=1)[0]
+
+    def with_target_batch(self, target, stats=None):
+        target_embeddings = self.embed([target], stats)
+
+        def apply(source):
+            source_embeddings = self.embed(source, stats)
+            if stats is not None:
+                start_time = default_timer()
             exp_target_embeddings = target_embeddings.expand(
                 * source_embeddings.size())
             distance = self.model.distances(source_embeddings,
                 exp_target_embeddings)
+            if stats is not None:
+                stats.add_time('model', default_timer() - start_time)
             return list(distance.data)
 
         return apply
 
-    def with_target(self, target):
-        e2s, a2s = self.encoder.encode_batch([target])
-        e2s = torch.autograd.Variable(e2s)
-        if self.is_cuda:
-            e2s = e2s.cuda(self.device)
-            a2s = a2s.cuda(self.device)
-        target_embeddings = self.model.embeddings(e2s, a2s)
+    def with_targets_batch(self, targets, stats=None):
+        """Estimate distances towards many targets at once.
+
+        Args:
+            targets: List of target expressions.
+            stats: If given, SearchStats recording the time spent.
+
+        Returns:
+            A function which, given a list of source expressions and the
+            list of the indices of their respective targets, returns the list
+            of estimated distances. All sources are estimated in a single
+            call to the network.
+        """
+
+        target_embeddings = self.embed(targets, stats)
+
+        def apply(source, indices):
+            source_embeddings = self.embed(source, stats)
+            if stats is not None:
+                start_time = default_timer()
+            indices = torch.LongTensor(indices)
+            if self.is_cuda:
+                indices = indices.cuda(self.device)
+            row_target_embeddings = target_embeddings.index_select(0,
+                torch.autograd.Variable(indices))
+            distance = self.model.distances(source_embeddings,
+                row_target_embeddings)
+            if stats is not None:
+                stats.add_time('model', default_timer() - start_time)
+            return list(distance.data)
+
+        return apply
+
+    def with_targets(self, targets, stats=None):
+        """Estimate distances towards all of many targets at once.
+
+        Args:
+            targets: List of target expressions.
+            stats: If given, SearchStats recording the time spent.
+
+        Returns:
+            A function which, given a list of source expressions, returns
+            for each source the list of its estimated distances to each
+            target. All pairs are estimated in a single call to the
+            network, against the matrix of the target embeddings.
+        """
+
+        target_embeddings = self.embed(targets, stats)
+
+        def apply(source):
+            source_embeddings = self.embed(source, stats)
+            if stats is not None:
+                start_time = default_timer()
+            n = source_embeddings.size(0)
+            (m, size) = target_embeddings.size()
+            firsts = source_embeddings.unsqueeze(1).expand(n, m, size)
+            seconds = target_embeddings.unsqueeze(0).expand(n, m, size)
+            distances = self.model.distances(
+                firsts.contiguous().view(n * m, size),
+                seconds.contiguous().view(n * m, size)).view(n, m)
+            if stats is not None:
+                stats.add_time('model', default_timer() - start_time)
+            return distances.data.tolist()
+
+        return apply
+
+    def with_target(self, target, stats=None):
+        target_embeddings = self.embed([target], stats)
 
         def apply(source):
             single = False
@@ -60,18 +235,17 @@ class Heuristics(object):
                 source = [source]
                 single = True
 
-            e1s, a1s = self.encoder.encode_batch(source)
-            e1s = torch.autograd.Variable(e1s)
-            if self.is_cuda:
-                e1s = e1s.cuda(self.device)
-                a1s = a1s.cuda(self.device)
-            source_embeddings = self.model.embeddings(e1s, a1s)
+            source_embeddings = self.embed(source, stats)
+            if stats is not None:
+                start_time = default_timer()
             exp_target_embeddings = target_embeddings.expand(
                 * source_embeddings.size())
             distance = self.model.distances(source_embeddings,
                 exp_target_embeddings)
             classes = self.model.classifications(
                 source_embeddings, exp_target_embeddings)
+            if stats is not None:
+                stats.add_time('model', default_timer() - start_time)
             if single:
                 predicted_distance = distance.data.squeeze(0)[0]
                 predicted_classes = classes.data.squeeze(0)
@@ -83,4 +257,224 @@ class Heuristics(object):
 
         return apply
 
+    def embedding_set(self):
+        """Return an empty EmbeddingSet using the distance of the model."""
+        return EmbeddingSet(self.model)
+
+
+class EmbeddingSet(object):
+    """Set of embeddings keyed by state, supporting nearest-neighbour queries.
+
+    Embeddings are stored in the first rows of a preallocated matrix,
+    whose capacity doubles when it is full. Adding embeddings thus copies
+    only them, and removing one moves the last row into its place.
+
+    Args:
+        model: The Net whose distance is used to compare embeddings.
+        chunk_size: Number of embeddings of the set compared at once
+            with each query embedding. Bounds the memory used by queries.
+        capacity: Initial number of rows of the matrix.
+    """
+
+    def __init__(self, model, chunk_size=4096, capacity=64):
+        self.model = model
+        self.chunk_size = chunk_size
+        self.capacity = capacity
+        self.matrix = None
+        self.keys = []
+        self.rows = {}
+        self.size = 0
+
+        # Number of changes made to the set.
+        self.revision = 0
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, key):
+        return key in self.rows
+
+    def add(self, embeddings, keys):
+        """Add embeddings, of shape `(N, embedding_size)`, to the set.
+
+        Args:
+            embeddings: The embeddings to add.
+            keys: The N distinct keys of the embeddings, absent from the set.
+        """
+
+        embeddings = embeddings.data
+        (n, size) = embeddings.size()
+        if self.matrix is None:
+            self.matrix = embeddings.new(max(self.capacity, n), size)
+        elif self.size + n > self.matrix.size(0):
+            capacity = self.matrix.size(0)
+            while self.size + n > capacity:
+                capacity *= 2
+            matrix = self.matrix.new(capacity, size)
+            matrix[:self.size] = self.matrix[:self.size]
+            self.matrix = matrix
+
+        self.matrix[self.size:self.size + n] = embeddings
+        for key in keys:
+            self.rows[key] = len(self.keys)
+            self.keys.append(key)
+        self.size += n
+        self.revision += 1
+
+    def remove(self, key):
+        """Remove the embedding of a key from the set."""
+
+        row = self.rows.pop(key)
+        last = self.size - 1
+        last_key = self.keys.pop()
+        if row != last:
+            self.matrix[row].copy_(self.matrix[last])
+            self.keys[row] = last_key
+            self.rows[last_key] = row
+        self.size -= 1
+        self.revision += 1
+
+    def nearest_distances(self, embeddings):
+        """Distance from each embedding to its nearest neighbour in the set.
+
+        Args:
+            embeddings: Query embeddings, of shape `(N, embedding_size)`.
+                The set must not be empty.
+
+        Returns:
+            Variable: The distances, of shape `(N,)`.
+        """
+
+        n = embeddings.size(0)
+        size = embeddings.size(1)
+        nearest = None
+        for start in range(0, self.size, self.chunk_size):
+            end = min(start + self.chunk_size, self.size)
+            others = torch.autograd.Variable(self.matrix[start:end])
+            m = end - start
+            firsts = embeddings.unsqueeze(1).expand(n, m, size)
+            seconds = others.unsqueeze(0).expand(n, m, size)
+            distances = self.model.distances(
+                firsts.contiguous().view(n * m, size),
+                seconds.contiguous().view(n * m, size)).view(n, m)
+            chunk_nearest = torch.min(distances, 1)[0]
+            if nearest is None:
+                nearest = chunk_nearest
+            else:
+                nearest = torch.min(nearest, chunk_nearest)
+        return nearest
+
+
+class MemoizedHeuristics(object):
+    """Heuristics remembering their estimates across searches.
+
+    Estimates are cached, keyed on the pair of the source and target
+    expressions, in a cache of bounded size evicting the least recently
+    used entries. Batched calls only send the missing sources to the
+    underlying heuristics. Other attributes are forwarded to them.
+
+    Args:
+        heuristics: The underlying heuristics.
+        capacity (int): Maximal number of cached estimates.
+        path: If given, file from which the cache is loaded, if it exists,
+            and to which `save` writes it.
+        codec: If given, Codec used to pack the expressions of the keys.
+    """
+
+    def __init__(self, heuristics, capacity, path=None, codec=None):
+        self.heuristics = heuristics
+        self.cache = LRUCache(capacity)
+        self.path = path
+        self.pack = codec.pack if codec is not None else lambda e: e
+        self.hits = 0
+        self.misses = 0
+
+        if path is not None and os.path.exists(path):
+            with open(path, 'rb') as store:
+                for (key, value) in pickle.load(store):
+                    self.cache.put(key, value)
+
+    def __getattr__(self, name):
+        if name == 'heuristics':
+            raise AttributeError(name)
+        return getattr(self.heuristics, name)
+
+    def save(self, path=None):
+        """Write the cache to a file, by default the one it was loaded from."""
+
+        path = path if path is not None else self.path
+        with open(path, 'wb') as store:
+            pickle.dump(list(self.cache.entries.items()), store,
+                        pickle.HIGHEST_PROTOCOL)
+
+    def memoize(self, apply, target, with_classes):
+        """Wrap a function estimating a list of sources towards a target.
+
+        Args:
+            apply: Function returning the estimates of a list of sources,
+                as a list of (distance, classes) pairs.
+            target: The target expression.
+            with_classes: Whether the classes of the estimates are needed.
+                Cached estimates without classes are then ignored.
+
+        Returns:
+            A function returning the estimates of a list of sources.
+        """
+
+        target_key = self.pack(target)
+
+        def estimates(source):
+            keys = [(self.pack(expr), target_key) for expr in source]
+            results = [self.cache.get(key) for key in keys]
+
+            missing = {}
+            for (expr, key, result) in zip(source, keys, results):
+                if result is None or (with_classes and result[1] is None):
+                    missing.setdefault(key, expr)
+                    self.misses += 1
+                else:
+                    self.hits += 1
+
+            if missing:
+                missing_keys = list(missing)
+                computed = apply([missing[key] for key in missing_keys])
+                for (key, result) in zip(missing_keys, computed):
+                    self.cache.put(key, result)
+                    missing[key] = result
+                results = [missing.get(key, result)
+                           for (key, result) in zip(keys, results)]
+            return results
+
+        return estimates
+
+    def with_target_batch(self, target, stats=None):
+        h = self.heuristics.with_target_batch(target, stats)
+
+        def apply(source):
+            return [(d, None) for d in h(source)]
+
+        estimates = self.memoize(apply, target, False)
+
+        def memoized(source):
+            return [d for (d, _) in estimates(source)]
+
+        return memoized
+
+    def with_target(self, target, stats=None):
+        h = self.heuristics.with_target(target, stats)
+
+        def apply(source):
+            if len(source) == 1:
+                return [h(source[0])]
+            return list(zip(* h(source)))
+
+        estimates = self.memoize(apply, target, True)
+
+        def memoized(source):
+            if not isinstance(source, (list, tuple)):
+                return estimates([source])[0]
+
+            results = estimates(source)
+            return ([d for (d, _) in results], [ts for (_, ts) in results])
 
+        return memoized
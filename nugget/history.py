@@ -0,0 +1,289 @@
+# Copyright 2018 EPFL.
+
+import argparse
+import gzip
+import math
+import os
+import struct
+import sys
+
+from nugget.expressions import transformations
+from nugget.packed import Codec
+
+# Columns of the CSV logs.
+CSV_HEADER = ','.join(['id','expr','estimatedDistance','action','parentId'])
+
+# Marker at the start of packed history files.
+PACKED_MAGIC = b'NGH1'
+
+# Id, parent id, action code, estimated distance and length
+# of the packed expression of each entry of packed history files.
+PACKED_ENTRY = struct.Struct('<iibdH')
+
+# Number of bytes of packed entries buffered before being compressed.
+PACKED_BUFFER_SIZE = 1 << 16
+
+# Extension of the log files of each format.
+extensions = {
+    'csv': '.csv',
+    'packed': '.hist.gz',
+}
+
+
+def csv_line(entry, codec=None):
+    """Format a history entry as a line of the CSV logs.
+
+    Args:
+        entry: The (id, expr, estimated distance, action, parent id) tuple.
+        codec: Codec used to unpack the expression, if it is packed.
+    """
+
+    (expr_id, expr, estimated_distance, action, parent_id) = entry
+    if codec is not None and isinstance(expr, bytes):
+        expr = codec.unpack(expr)
+    return ','.join([
+        str(expr_id),
+        str(expr),
+        str(estimated_distance) if estimated_distance is not None else '',
+        action if action is not None else '',
+        str(parent_id) if parent_id is not None else ''])
+
+
+class NullHistory(object):
+    """History discarding its entries, only counting them."""
+
+    def __init__(self):
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, entry):
+        self.size += 1
+
+    def close(self, keep=True):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class CSVHistory(object):
+    """History streamed to a CSV file, in the format of `history_to_csv`.
+
+    Entries are written as they are appended, and not kept in memory.
+
+    Args:
+        path: The output file.
+        codec: Codec used to unpack the packed expressions, if any.
+    """
+
+    def __init__(self, path, codec=None):
+        self.path = path
+        self.codec = codec
+        self.size = 0
+        self.file = open(path, 'w')
+        self.file.write(CSV_HEADER)
+
+    def __len__(self):
+        return self.size
+
+    def append(self, entry):
+        self.file.write('\n')
+        self.file.write(csv_line(entry, self.codec))
+        self.size += 1
+
+    def close(self, keep=True):
+        """Close the file, which is removed unless `keep` is set."""
+
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        if not keep:
+            os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class PackedHistory(object):
+    """History streamed to a gzip file of packed entries.
+
+    Expressions are stored packed, along with integer ids, parent ids
+    and action codes, so that entries take a few dozen bytes before
+    compression. Entries are compressed as they are appended, and not
+    kept in memory. The file starts with the atoms of the codec, and can
+    be read back with `read_history`.
+
+    Args:
+        path: The output file.
+        codec: Codec used to pack the expressions, or with which they
+            are already packed.
+    """
+
+    def __init__(self, path, codec):
+        self.path = path
+        self.codec = codec
+        self.size = 0
+        self.action_codes = dict(
+            (t, i) for (i, t) in enumerate(transformations))
+        self.buffer = bytearray()
+        self.file = gzip.open(path, 'wb')
+
+        atoms = '\n'.join(codec.atoms).encode('utf-8')
+        self.file.write(PACKED_MAGIC)
+        self.file.write(struct.pack('<H', len(atoms)))
+        self.file.write(atoms)
+
+    def __len__(self):
+        return self.size
+
+    def append(self, entry):
+        (expr_id, expr, estimated_distance, action, parent_id) = entry
+        if not isinstance(expr, bytes):
+            expr = self.codec.pack(expr)
+        if estimated_distance is None:
+            estimated_distance = math.nan
+        self.buffer += PACKED_ENTRY.pack(
+            expr_id,
+            parent_id if parent_id is not None else -1,
+            self.action_codes[action] if action is not None else -1,
+            estimated_distance,
+            len(expr))
+        self.buffer += expr
+        self.size += 1
+        if len(self.buffer) >= PACKED_BUFFER_SIZE:
+            self.file.write(self.buffer)
+            self.buffer = bytearray()
+
+    def close(self, keep=True):
+        """Close the file, which is removed unless `keep` is set."""
+
+        if self.file is None:
+            return
+        self.file.write(self.buffer)
+        self.buffer = bytearray()
+        self.file.close()
+        self.file = None
+        if not keep:
+            os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_history(path, log_format='csv', codec=None):
+    """Create the sink writing a history to a file.
+
+    Args:
+        path: The output file, without extension.
+        log_format: Either 'csv' or 'packed'. See `extensions`.
+        codec: Codec of the packed expressions of the history, if any.
+            Required by the 'packed' format.
+    """
+
+    path += extensions[log_format]
+    if log_format == 'csv':
+        return CSVHistory(path, codec)
+    elif log_format == 'packed':
+        return PackedHistory(path, codec)
+    else:
+        raise ValueError("Unknown log format: " + str(log_format))
+
+
+def read_packed_history(path):
+    """Read the entries of a history written by `PackedHistory`.
+
+    Returns:
+        A generator of (id, expr, estimated distance, action, parent id)
+        tuples, with unpacked expressions.
+    """
+
+    with gzip.open(path, 'rb') as inputFile:
+        if inputFile.read(len(PACKED_MAGIC)) != PACKED_MAGIC:
+            raise ValueError("Not a packed history: " + path)
+        (n,) = struct.unpack('<H', inputFile.read(2))
+        atoms = inputFile.read(n).decode('utf-8')
+        codec = Codec(atoms.split('\n') if atoms else [])
+
+        while True:
+            header = inputFile.read(PACKED_ENTRY.size)
+            if not header:
+                break
+            (expr_id, parent_id, action, estimated_distance, length) = \
+                PACKED_ENTRY.unpack(header)
+            expr = codec.unpack(inputFile.read(length))
+            yield (expr_id,
+                   expr,
+                   estimated_distance
+                       if not math.isnan(estimated_distance) else None,
+                   transformations[action] if action >= 0 else None,
+                   parent_id if parent_id >= 0 else None)
+
+
+def read_csv_history(path):
+    """Read the entries of a history written by `CSVHistory`.
+
+    Returns:
+        A generator of (id, expr, estimated distance, action, parent id)
+        tuples, in which expressions are kept as strings.
+    """
+
+    with open(path) as inputFile:
+        if inputFile.readline().rstrip('\n') != CSV_HEADER:
+            raise ValueError("Not a CSV history: " + path)
+        for line in inputFile:
+            (expr_id, expr, estimated_distance, action, parent_id) = \
+                line.rstrip('\n').split(',')
+            yield (int(expr_id),
+                   expr,
+                   float(estimated_distance) if estimated_distance else None,
+                   action if action else None,
+                   int(parent_id) if parent_id else None)
+
+
+def read_history(path):
+    """Read the entries of a history file of either format."""
+
+    with open(path, 'rb') as inputFile:
+        gzipped = inputFile.read(2) == b'\x1f\x8b'
+    if gzipped:
+        return read_packed_history(path)
+    else:
+        return read_csv_history(path)
+
+
+def write_csv(history, outputFile):
+    """Write history entries to a file, in the format of `history_to_csv`."""
+
+    outputFile.write(CSV_HEADER)
+    for entry in history:
+        outputFile.write('\n')
+        outputFile.write(csv_line(entry))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Convert a history log back to CSV.")
+    parser.add_argument("input", type=str,
+        help="history file, packed or CSV")
+    parser.add_argument("-o", "--output", type=str,
+        help="output CSV file, standard output by default")
+    args = parser.parse_args()
+
+    if args.output is not None:
+        with open(args.output, 'w') as outputFile:
+            write_csv(read_history(args.input), outputFile)
+    else:
+        write_csv(read_history(args.input), sys.stdout)
@@ -0,0 +1,284 @@
+# Copyright 2018 EPFL.
+
+from timeit import default_timer
+
+import numpy as np
+import torch
+
+from nugget.encoder import ExpressionEncoder
+from nugget.network import Net
+from nugget.utils import LRUCache
+
+def to_numpy(parameter):
+    """Copy a parameter of a torch module to a float32 NumPy array."""
+    return parameter.data.cpu().numpy().astype(np.float32)
+
+
+class NumpyNet(object):
+    """Inference-only copy of a `Net`, evaluated with NumPy.
+
+    The weights of the network are exported once, so that evaluating the
+    network involves neither autograd nor the dispatch costs of PyTorch
+    on small tensors.
+
+    Args:
+        net: The trained Net.
+    """
+
+    def __init__(self, net):
+        unit = net.treelstm.unit
+        self.memory_size = unit.memory_size
+        self.branching_factor = unit.branching_factor
+
+        # The inputs are one-hot vectors, so that the input contributions
+        # to the gates i, o and u are rows of a table, indexed by node type.
+        self.input_table = np.concatenate([
+            to_numpy(l.weight).T + to_numpy(l.bias)
+            for l in [unit.wi_net, unit.wo_net, unit.wu_net]], axis=1)
+
+        # Contributions of the hidden state of each child to the gates.
+        self.child_weights = [np.concatenate([
+            to_numpy(l.weight).T
+            for l in [unit.ui_nets[k], unit.uo_nets[k], unit.uu_nets[k]]],
+            axis=1) for k in range(self.branching_factor)]
+
+        self.layers = [(to_numpy(l.weight).T, to_numpy(l.bias))
+                       for l in [net.fc1, net.fc2, net.fc3]]
+        self.classes = (to_numpy(net.classes.weight).T,
+                        to_numpy(net.classes.bias))
+
+    def embeddings(self, types, children, known=None):
+        """Compute the embeddings of nodes, level by level.
+
+        Args:
+            types: List of arrays, one per level, of the input index
+                of each node.
+            children: List of arrays, one per level, of shape
+                `(branching_factor, n)`, holding the index of each child of
+                each node among all nodes, or -1 for missing children.
+                Nodes are numbered in order of levels, and children must
+                appear in earlier levels.
+            known: If given, array of the embeddings of nodes already
+                computed, of shape `(K, memory_size)`. Those nodes are
+                numbered first, and may appear as children.
+
+        Returns:
+            array: The embeddings of all nodes, known ones included,
+            of shape `(K + N, memory_size)`.
+        """
+
+        m = self.memory_size
+        start = len(known) if known is not None else 0
+        total = start + sum(len(t) for t in types)
+
+        # The last row stays zero, and is selected for missing children.
+        hidden = np.zeros((total + 1, m), dtype=np.float32)
+        if known is not None:
+            hidden[:start] = known
+        for (level_types, level_children) in zip(types, children):
+            gates = self.input_table[level_types]
+            for (k, weights) in enumerate(self.child_weights):
+                gates += hidden[level_children[k]].dot(weights)
+
+            i = sigmoid(gates[:, :m])
+            o = sigmoid(gates[:, m:2 * m])
+            u = np.tanh(gates[:, 2 * m:])
+
+            # As in treenet's TreeLSTMUnit, the forget gates do not
+            # contribute to the memory cells.
+            c = i * u
+            end = start + len(level_types)
+            hidden[start:end] = o * np.tanh(c)
+            start = end
+
+        return hidden[:total]
+
+    def distances(self, first_embeddings, second_embeddings):
+        return np.abs(second_embeddings - first_embeddings).sum(axis=1)
+
+    def classifications(self, first_embeddings, second_embeddings):
+        hidden = np.concatenate([first_embeddings, second_embeddings], axis=1)
+        for (weight, bias) in self.layers:
+            hidden = np.maximum(hidden.dot(weight) + bias, 0)
+        (weight, bias) = self.classes
+        return hidden.dot(weight) + bias
+
+
+def sigmoid(x):
+    return 0.5 * np.tanh(0.5 * x) + 0.5
+
+
+class NumpyHeuristics(object):
+    """Distance and transformation estimates, computed on the CPU with NumPy.
+
+    Interchangeable with `Heuristics` for `with_target`, `with_target_batch`,
+    `with_targets_batch` and `with_targets`, including the recording of
+    the time spent in SearchStats, and much faster on small queries.
+
+    Args:
+        atoms: Available atoms.
+        model: File of the trained model.
+        embedding_size: Embedding size of the model.
+        cache_size: If given, the embeddings of up to that many
+            subexpressions are cached, as with `Heuristics`, so that only
+            subexpressions absent from the cache are evaluated.
+    """
+
+    def __init__(self, atoms, model, embedding_size=None, cache_size=None):
+        if embedding_size is not None:
+            net = Net(len(atoms), embedding_size)
+        else:
+            net = Net(len(atoms))
+        net.load_state_dict(torch.load(model,
+            map_location=lambda x, _: x.cpu()))
+        self.model = NumpyNet(net)
+
+        self.encoder = ExpressionEncoder(atoms)
+        self.cache = LRUCache(cache_size) if cache_size is not None else None
+
+    def embed(self, exprs, stats=None):
+        """Compute the embeddings of a list of expressions.
+
+        Shared subexpressions are only evaluated once, and those
+        found in the cache not at all.
+
+        Returns:
+            array: The embeddings, of shape `(len(exprs), embedding_size)`.
+        """
+
+        if stats is not None:
+            start_time = default_timer()
+
+        heights = {}
+        known = {}
+        stack = list(exprs)
+        while stack:
+            expr = stack.pop()
+            if expr in heights or expr in known:
+                continue
+            if self.cache is not None:
+                embedding = self.cache.get(expr)
+                if embedding is not None:
+                    known[expr] = embedding
+                    continue
+            heights[expr] = expr.height()
+            stack.extend(expr.get_children())
+
+        levels = {}
+        for (expr, height) in heights.items():
+            levels.setdefault(height, []).append(expr)
+
+        branching_factor = self.model.branching_factor
+        numbers = {}
+        for expr in known:
+            numbers[expr] = len(numbers)
+        for height in sorted(levels):
+            for expr in levels[height]:
+                numbers[expr] = len(numbers)
+
+        types = []
+        children = []
+        for height in sorted(levels):
+            nodes = levels[height]
+            level_types = np.empty(len(nodes), dtype=np.int64)
+            level_children = np.full((branching_factor, len(nodes)), -1,
+                                     dtype=np.int64)
+            for (j, expr) in enumerate(nodes):
+                level_types[j] = self.encoder.index(expr)
+                for (k, child) in enumerate(expr.get_children()):
+                    level_children[k, j] = numbers[child]
+            types.append(level_types)
+            children.append(level_children)
+
+        if stats is not None:
+            encoded_time = default_timer()
+            stats.add_time('encoding', encoded_time - start_time)
+        hidden = self.model.embeddings(types, children,
+            np.array(list(known.values())) if known else None)
+        if stats is not None:
+            stats.add_time('model', default_timer() - encoded_time)
+        if self.cache is not None:
+            for expr in heights:
+                self.cache.put(expr, hidden[numbers[expr]].copy())
+        return hidden[[numbers[expr] for expr in exprs]]
+
+    def with_target_batch(self, target, stats=None):
+        target_embedding = self.embed([target], stats)
+
+        def apply(source):
+            source_embeddings = self.embed(source, stats)
+            if stats is not None:
+                start_time = default_timer()
+            distances = self.model.distances(
+                source_embeddings, target_embedding)
+            if stats is not None:
+                stats.add_time('model', default_timer() - start_time)
+            return distances.tolist()
+
+        return apply
+
+    def with_targets_batch(self, targets, stats=None):
+        """Estimate distances towards many targets at once.
+        See `Heuristics.with_targets_batch`."""
+
+        target_embeddings = self.embed(targets, stats)
+
+        def apply(source, indices):
+            source_embeddings = self.embed(source, stats)
+            if stats is not None:
+                start_time = default_timer()
+            distances = self.model.distances(source_embeddings,
+                target_embeddings[indices])
+            if stats is not None:
+                stats.add_time('model', default_timer() - start_time)
+            return distances.tolist()
+
+        return apply
+
+    def with_targets(self, targets, stats=None):
+        """Estimate distances towards all of many targets at once.
+        See `Heuristics.with_targets`."""
+
+        target_embeddings = self.embed(targets, stats)
+
+        def apply(source):
+            source_embeddings = self.embed(source, stats)
+            if stats is not None:
+                start_time = default_timer()
+            n = len(source)
+            m = len(targets)
+            distances = self.model.distances(
+                np.repeat(source_embeddings, m, axis=0),
+                np.tile(target_embeddings, (n, 1))).reshape(n, m)
+            if stats is not None:
+                stats.add_time('model', default_timer() - start_time)
+            return distances.tolist()
+
+        return apply
+
+    def with_target(self, target, stats=None):
+        target_embedding = self.embed([target], stats)
+
+        def apply(source):
+            single = False
+            if not isinstance(source, (list, tuple)):
+                source = [source]
+                single = True
+
+            source_embeddings = self.embed(source, stats)
+            if stats is not None:
+                start_time = default_timer()
+            exp_target_embeddings = np.repeat(
+                target_embedding, len(source), axis=0)
+            distance = self.model.distances(source_embeddings,
+                exp_target_embeddings)
+            classes = self.model.classifications(
+                source_embeddings, exp_target_embeddings)
+            if stats is not None:
+                stats.add_time('model', default_timer() - start_time)
+            if single:
+                return (float(distance[0]), classes[0].tolist())
+            else:
+                return (distance.tolist(), classes.tolist())
+
+        return apply
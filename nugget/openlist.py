@@ -0,0 +1,116 @@
+# Copyright 2018 EPFL.
+
+from collections import deque
+from heapq import heappush, heappop
+
+class HeapOpenList(object):
+    """Open list kept as a binary heap of (priority, item) pairs.
+
+    Entries of equal priority are ordered by their items, as with `heapq`.
+    """
+
+    def __init__(self):
+        self.heap = []
+
+    def __len__(self):
+        return len(self.heap)
+
+    def __bool__(self):
+        return bool(self.heap)
+
+    __nonzero__ = __bool__
+
+    def push(self, priority, item):
+        heappush(self.heap, (priority, item))
+
+    def peek(self):
+        """Return the (priority, item) pair of lowest priority."""
+        return self.heap[0]
+
+    def pop(self):
+        """Remove and return the (priority, item) pair of lowest priority."""
+        return heappop(self.heap)
+
+
+class BucketOpenList(object):
+    """Open list grouping entries in buckets of quantized priority.
+
+    Priorities are rounded down to multiples of `resolution`. Entries of the
+    same bucket are popped in insertion order, or in reverse insertion order
+    when `lifo` is set, and items are never compared. Pushing into and
+    popping from an existing bucket take constant time. Only creating and
+    exhausting buckets involve a heap, over the buckets.
+
+    Args:
+        resolution (float): Width of the buckets.
+        lifo (bool): Whether to pop the most recent entry of the bucket
+            first, rather than the oldest.
+    """
+
+    def __init__(self, resolution=0.1, lifo=False):
+        self.resolution = resolution
+        self.lifo = lifo
+        self.buckets = {}
+        self.keys = []
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __bool__(self):
+        return self.size > 0
+
+    __nonzero__ = __bool__
+
+    def push(self, priority, item):
+        key = int(priority // self.resolution)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = deque()
+            self.buckets[key] = bucket
+            heappush(self.keys, key)
+        bucket.append((priority, item))
+        self.size += 1
+
+    def peek(self):
+        """Return the oldest, or newest, (priority, item) pair
+        of the lowest bucket."""
+
+        bucket = self.buckets[self.keys[0]]
+        return bucket[-1] if self.lifo else bucket[0]
+
+    def pop(self):
+        """Remove and return the oldest, or newest, (priority, item) pair
+        of the lowest bucket."""
+
+        key = self.keys[0]
+        bucket = self.buckets[key]
+        entry = bucket.pop() if self.lifo else bucket.popleft()
+        if not bucket:
+            del self.buckets[key]
+            heappop(self.keys)
+        self.size -= 1
+        return entry
+
+
+class TimedOpenList(object):
+    """Open list adding the time spent in its operations to search stats.
+
+    Args:
+        open_list: The underlying open list.
+        stats: The SearchStats, whose `open_list` phase is updated.
+    """
+
+    def __init__(self, open_list, stats):
+        self.open_list = open_list
+        self.push = stats.timed('open_list', open_list.push)
+        self.peek = stats.timed('open_list', open_list.peek)
+        self.pop = stats.timed('open_list', open_list.pop)
+
+    def __len__(self):
+        return len(self.open_list)
+
+    def __bool__(self):
+        return bool(self.open_list)
+
+    __nonzero__ = __bool__
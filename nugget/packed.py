@@ -0,0 +1,142 @@
+# Copyright 2018 EPFL.
+
+from nugget.expressions import *
+from nugget.zipper import Context, Zipper
+
+# Codes of the non-atom tokens. Atoms follow, in the order given to the codec.
+PLUS_CODE = 0
+TIMES_CODE = 1
+FOCUS_CODE = 2
+
+
+class Codec(object):
+    """Compact encoding of expressions as byte strings.
+
+    An expression is packed into its prefix notation, one byte per token,
+    using the alphabet `+`, `*`, `C` followed by the atoms. Packed expressions
+    are plain `bytes`, which are cheap to store, hash, compare and pickle.
+    They can thus be used directly as keys of visited sets, and to transfer
+    states between processes.
+
+    Args:
+        atoms: Available atoms. At most 253 atoms are supported.
+    """
+
+    def __init__(self, atoms):
+        self.atoms = list(atoms)
+        if len(self.atoms) + NON_ATOM_ENTRIES > 256:
+            raise ValueError("Too many atoms: {}".format(len(self.atoms)))
+
+        self.atom_codes = {}
+        for (i, atom) in enumerate(self.atoms):
+            self.atom_codes[atom] = i + NON_ATOM_ENTRIES
+
+        # Decoding table, indexed by code.
+        self.leaves = [None] * NON_ATOM_ENTRIES + [Atom(a) for a in self.atoms]
+
+    def __getstate__(self):
+        return self.atoms
+
+    def __setstate__(self, atoms):
+        self.__init__(atoms)
+
+    def pack(self, state):
+        """Pack an expression.
+
+        Args:
+            state: An expression, or a Zipper.
+
+        Returns:
+            bytes: The packed expression.
+        """
+
+        if isinstance(state, Zipper):
+            state = state.to_expr()
+
+        atom_codes = self.atom_codes
+        codes = bytearray()
+        stack = [state]
+        while stack:
+            expr = stack.pop()
+            if expr.is_binary():
+                codes.append(PLUS_CODE if expr.operator == PLUS else TIMES_CODE)
+                stack.append(expr.rhs)
+                stack.append(expr.lhs)
+            elif expr.is_focus():
+                codes.append(FOCUS_CODE)
+                stack.append(expr.expr)
+            else:
+                codes.append(atom_codes[expr.identifier])
+        return bytes(codes)
+
+    def unpack(self, packed):
+        """Unpack an expression.
+
+        Args:
+            packed (bytes): A packed expression.
+
+        Returns:
+            Expression: The unpacked expression.
+        """
+
+        leaves = self.leaves
+        stack = []
+        for code in reversed(bytearray(packed)):
+            if code >= NON_ATOM_ENTRIES:
+                stack.append(leaves[code])
+            elif code == FOCUS_CODE:
+                stack.append(Focus(stack.pop()))
+            else:
+                lhs = stack.pop()
+                rhs = stack.pop()
+                stack.append(Binary(
+                    PLUS if code == PLUS_CODE else TIMES, lhs, rhs))
+
+        if len(stack) != 1:
+            raise ValueError("Invalid packed expression: {!r}".format(packed))
+        return stack[0]
+
+    def unpack_state(self, packed):
+        """Unpack an expression directly into a Zipper.
+
+        Args:
+            packed (bytes): A packed expression, containing a focus.
+
+        Returns:
+            Zipper: The unpacked state.
+        """
+
+        leaves = self.leaves
+
+        # Each entry holds a subexpression without focus, and, if the
+        # subexpression contained the focus, the list of steps from the
+        # focus up to the subexpression.
+        stack = []
+        focused = None
+        for code in reversed(bytearray(packed)):
+            if code >= NON_ATOM_ENTRIES:
+                stack.append((leaves[code], None))
+            elif code == FOCUS_CODE:
+                (focused, _) = stack.pop()
+                stack.append((focused, []))
+            else:
+                operator = PLUS if code == PLUS_CODE else TIMES
+                (lhs, lhs_steps) = stack.pop()
+                (rhs, rhs_steps) = stack.pop()
+                if lhs_steps is not None:
+                    lhs_steps.append((operator, LEFT, rhs))
+                    steps = lhs_steps
+                elif rhs_steps is not None:
+                    rhs_steps.append((operator, RIGHT, lhs))
+                    steps = rhs_steps
+                else:
+                    steps = None
+                stack.append((Binary(operator, lhs, rhs), steps))
+
+        if len(stack) != 1 or stack[0][1] is None:
+            raise ValueError("Invalid packed state: {!r}".format(packed))
+
+        context = None
+        for (operator, side, sibling) in reversed(stack[0][1]):
+            context = Context(operator, side, sibling, context)
+        return Zipper(focused, context)
@@ -0,0 +1,385 @@
+# Copyright 2018 EPFL.
+
+import argparse
+import multiprocessing
+from multiprocessing.connection import wait
+import os
+import queue
+import threading
+from timeit import default_timer
+
+from nugget.history import NullHistory, open_history
+from nugget.packed import Codec
+from nugget.search import *
+from nugget.utils import Budget
+
+DEFAULT_DATA = "data/testing.txt"
+DEFAULT_LOGS_DIR = "logs/"
+DEFAULT_ATOMS = list("abc")
+DEFAULT_PENALTY = 0.0
+DEFAULT_BATCH_SIZE = 64
+DEFAULT_STRATEGIES = ["bfs", "nngs", "batch-nngs"]
+
+# Message asking a worker to stop its current search.
+CANCEL = "cancel"
+
+
+def run_bfs(from_expr, to_expr, heuristics, codec, options, budget,
+            history):
+    return breadth_first_search(from_expr, to_expr, codec=codec,
+        budget=budget, history=history)
+
+def run_nngs(from_expr, to_expr, heuristics, codec, options, budget,
+             history):
+    return best_first_search(from_expr, to_expr, heuristics,
+        options['penalty'], codec=codec, budget=budget, history=history)
+
+def run_batch_nngs(from_expr, to_expr, heuristics, codec, options, budget,
+                   history):
+    return batch_best_first_search(from_expr, to_expr, heuristics,
+        options['penalty'], options['batch_size'], codec=codec,
+        budget=budget, history=history)
+
+# Search function of each strategy, and whether it needs heuristics.
+strategies = {
+    "bfs": (run_bfs, False),
+    "nngs": (run_nngs, True),
+    "batch-nngs": (run_batch_nngs, True),
+}
+
+
+def listen(connection, problems):
+    """Receive the messages of the portfolio in a worker.
+
+    Problems are queued along with the Budget of their search, which is
+    cancelled when CANCEL is received. None is queued once the portfolio
+    stops the worker, or is gone.
+    """
+
+    budget = None
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:
+            message = None
+        if message is None:
+            problems.put(None)
+            break
+        if message == CANCEL:
+            if budget is not None:
+                budget.cancel()
+        else:
+            budget = Budget()
+            problems.put((message, budget))
+
+def worker(connection, strategy, atoms, model, options):
+    """Main loop of the process running one strategy.
+
+    The model is loaded once, after which True is sent. Problems are then
+    received as pairs of packed expressions, and the results sent back
+    with packed expressions, until None is received. A search is stopped
+    between two expansions when CANCEL is received, None being sent back
+    as for searches not finding any path. Without logs, histories are
+    only counted, and not sent back.
+    """
+
+    (search, guided) = strategies[strategy]
+    codec = Codec(atoms)
+
+    heuristics = None
+    if guided:
+        if options['numpy']:
+            from nugget.inference import NumpyHeuristics
+            heuristics = NumpyHeuristics(atoms, model,
+                options['embedding_size'])
+        else:
+            from nugget.heuristics import Heuristics
+            heuristics = Heuristics(atoms, model,
+                options['embedding_size'])
+    connection.send(True)
+
+    # Receiving the messages in the background, so that cancellations
+    # reach the searches while they run.
+    problems = queue.Queue()
+    listener = threading.Thread(target=listen, args=(connection, problems))
+    listener.daemon = True
+    listener.start()
+
+    while True:
+        received = problems.get()
+        if received is None:
+            break
+
+        (problem, budget) = received
+        from_expr = codec.unpack(problem[0])
+        to_expr = codec.unpack(problem[1])
+        history = NullHistory() if not options['logs'] else None
+        result = search(from_expr, to_expr, heuristics, codec, options,
+            budget, history)
+        if result:
+            (path, actions, history) = result
+            result = ([codec.pack(e) for e in path], actions, history)
+        else:
+            # Not found, or cancelled.
+            result = None
+        connection.send(result)
+
+
+class Portfolio(object):
+    """Races several search strategies on each problem.
+
+    Each strategy runs in its own process, which loads the model once.
+    All strategies are given each problem, and the first path found is
+    returned. The processes still searching are then asked to stop, which
+    they do between two expansions, and are waited for, so that all
+    strategies race on the next problem. Only processes which die are
+    replaced by fresh ones. Those load the model in the background, and
+    join the races of the problems given once they are ready. A strategy
+    whose process dies while loading the model is marked as failed, in
+    `failed`, and no longer run.
+
+    Problems and results are transferred as packed expressions. Histories
+    thus hold packed expressions, to be unpacked with `codec`.
+
+    Args:
+        atoms: Available atoms.
+        model: File of the trained model.
+        strategies: Names of the strategies, keys of `strategies`.
+        embedding_size: Embedding size of the model.
+        penalty: Depth penalty of the guided searches.
+        batch_size: Batch size of the batch searches.
+        numpy: Whether to evaluate the network with NumPy.
+        logs: Whether to send the histories back. Otherwise, histories
+            are NullHistory objects, only counting the visited states.
+    """
+
+    def __init__(self, atoms, model, strategies=DEFAULT_STRATEGIES,
+                 embedding_size=None, penalty=DEFAULT_PENALTY,
+                 batch_size=DEFAULT_BATCH_SIZE, numpy=False, logs=True):
+        self.atoms = list(atoms)
+        self.model = model
+        self.strategies = list(strategies)
+        self.options = {
+            'embedding_size': embedding_size,
+            'penalty': penalty,
+            'batch_size': batch_size,
+            'numpy': numpy,
+            'logs': logs,
+        }
+        self.codec = Codec(atoms)
+        self.context = multiprocessing.get_context("spawn")
+        self.workers = [self.spawn(s) for s in self.strategies]
+        self.ready = [False] * len(self.workers)
+        self.failed = [False] * len(self.workers)
+        self.wins = dict((s, 0) for s in self.strategies)
+
+    def spawn(self, strategy):
+        (connection, worker_connection) = self.context.Pipe()
+        process = self.context.Process(target=worker, args=(worker_connection,
+            strategy, self.atoms, self.model, self.options))
+        process.daemon = True
+        process.start()
+        worker_connection.close()
+        return (process, connection)
+
+    def respawn(self, i):
+        (process, connection) = self.workers[i]
+        process.terminate()
+        process.join()
+        connection.close()
+        self.workers[i] = self.spawn(self.strategies[i])
+        self.ready[i] = False
+
+    def solve(self, from_expr, to_expr, timeout=None):
+        """Search a path with all strategies, keeping the first one found.
+
+        Args:
+            from_expr: The source expression.
+            to_expr: The target expression.
+            timeout: If given, time in seconds after which all strategies
+                are cancelled.
+
+        Returns:
+            The name of the winning strategy and its result, a (path,
+            actions, history) tuple, or (None, None) if no strategy found
+            a path in time.
+
+        Raises:
+            RuntimeError: If all strategies failed to load the model.
+        """
+
+        # Taking note of the processes done loading the model,
+        # waiting for one if none is ready yet.
+        while True:
+            loading = []
+            for (i, (_, connection)) in enumerate(self.workers):
+                if self.ready[i] or self.failed[i]:
+                    continue
+                if connection.poll():
+                    try:
+                        self.ready[i] = connection.recv()
+                    except EOFError:
+                        # Loading the model would most likely fail again.
+                        self.failed[i] = True
+                        continue
+                if not self.ready[i]:
+                    loading.append(connection)
+            if any(self.ready):
+                break
+            if not loading:
+                raise RuntimeError("All strategies failed to load the model.")
+            wait(loading)
+
+        problem = (self.codec.pack(from_expr), self.codec.pack(to_expr))
+        running = {}
+        for (i, (_, connection)) in enumerate(self.workers):
+            if self.ready[i]:
+                try:
+                    connection.send(problem)
+                except OSError:
+                    # The process died, which the pipe reports below.
+                    pass
+                running[connection] = i
+
+        deadline = None
+        if timeout is not None:
+            deadline = default_timer() + timeout
+
+        winner = None
+        result = None
+        while running and winner is None:
+            remaining = None
+            if deadline is not None:
+                remaining = max(deadline - default_timer(), 0)
+            ready = wait(list(running), remaining)
+            if not ready:
+                break
+
+            for connection in ready:
+                i = running.pop(connection)
+                try:
+                    result = connection.recv()
+                except EOFError:
+                    # The process died.
+                    self.respawn(i)
+                    continue
+                if result is not None:
+                    winner = i
+                    break
+
+        # Cancelling the strategies still running, and waiting for them
+        # to stop, discarding their results.
+        for connection in running:
+            try:
+                connection.send(CANCEL)
+            except OSError:
+                # The process died, which the pipe reports below.
+                pass
+        while running:
+            for connection in wait(list(running)):
+                i = running.pop(connection)
+                try:
+                    connection.recv()
+                except EOFError:
+                    # The process died.
+                    self.respawn(i)
+
+        if winner is None:
+            return (None, None)
+
+        strategy = self.strategies[winner]
+        self.wins[strategy] += 1
+        (path, actions, history) = result
+        path = [self.codec.unpack(e) for e in path]
+        return (strategy, (path, actions, history))
+
+    def close(self):
+        """Stop all processes."""
+        for (i, (process, connection)) in enumerate(self.workers):
+            if self.ready[i]:
+                try:
+                    connection.send(None)
+                except OSError:
+                    # The process already died.
+                    pass
+            else:
+                process.terminate()
+            process.join()
+            connection.close()
+        self.workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+if __name__ == "__main__":
+
+    from nugget.reader import Reader
+
+    parser = argparse.ArgumentParser(
+        description="Solve search problems with a portfolio of strategies.")
+    parser.add_argument("model", type=str,
+        help="trained model")
+    parser.add_argument("-d", "--data", type=str,
+        help="testing data file",
+        default=DEFAULT_DATA)
+    parser.add_argument("-l", "--log-dir", type=str,
+        help="output directory for the history logs",
+        default=DEFAULT_LOGS_DIR)
+    parser.add_argument("--no-logs", action="store_true",
+        help="disable logging of search history")
+    parser.add_argument("--log-format", choices=["csv", "packed"],
+        help="format of the history logs",
+        default="csv")
+    parser.add_argument("-a", "--atoms", nargs="+", type=str,
+        help="atoms",
+        default=DEFAULT_ATOMS)
+    parser.add_argument("-p", "--penalty", type=float,
+        help="depth penalty",
+        default=DEFAULT_PENALTY)
+    parser.add_argument("-b", "--batch", help="batch size", type=int,
+        default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("-s", "--size", help="embedding size", type=int)
+    parser.add_argument("--strategies", nargs="+", type=str,
+        help="strategies to race",
+        choices=sorted(strategies),
+        default=DEFAULT_STRATEGIES)
+    parser.add_argument("--numpy", action="store_true",
+        help="evaluate the network on CPU with NumPy")
+    parser.add_argument("--timeout", type=float, help="Timeout")
+    args = parser.parse_args()
+
+    portfolio = Portfolio(args.atoms, args.model, args.strategies,
+        args.size, args.penalty, args.batch, args.numpy, not args.no_logs)
+
+    print(",".join([
+        "id",
+        "strategy",
+        "path_length",
+        "visited_states",
+        "time"]))
+
+    with portfolio:
+        for (i, (a, b, _, _)) in enumerate(Reader(args.data).entries()):
+            start_time = default_timer()
+            (strategy, result) = portfolio.solve(a, b, args.timeout)
+            end_time = default_timer()
+
+            if result is not None:
+                (path, actions, history) = result
+                if not args.no_logs:
+                    with open_history(os.path.join(args.log_dir,
+                            "{}-portfolio".format(i)), args.log_format,
+                            portfolio.codec) as outputHistory:
+                        for entry in history:
+                            outputHistory.append(entry)
+
+            print(','.join([
+                str(i),
+                strategy if result is not None else "",
+                str(len(actions)) if result is not None else "",
+                str(len(history)) if result is not None else "",
+                str(end_time - start_time)]))
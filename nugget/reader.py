@@ -5,10 +5,55 @@ from torch import autograd
 
 from nugget.expressions import *
 
+# Number of bytes of records read and parsed at once.
+DEFAULT_BLOCK_SIZE = 1 << 20
+
+# Index of each transformation, by name.
+transformation_indices = dict((t, i) for (i, t) in enumerate(transformations))
+
+
+def parse_records(block):
+    """Parse a block of records.
+
+    Records are of the form `DISTANCE ; FIRST ; SECOND ; TRANSFORMATIONS`.
+    Expressions shared by several records of the block are parsed only once.
+
+    Args:
+        block: Sequence of lines, each holding one record.
+
+    Returns:
+        list: The parsed records, as tuples `(first, second, distance,
+        transformation)`. Negative distances are returned as None,
+        as are unknown transformations.
+    """
+
+    parsed = {}
+    records = []
+    for line in block:
+        [d, a, b, ms] = line.rstrip("\n").split(" ; ")
+
+        t = transformation_indices.get(ms.split(" , ", 1)[0])
+
+        d = int(d)
+        if d < 0:
+            d = None
+
+        a_expr = parsed.get(a)
+        if a_expr is None:
+            a_expr = parsed[a] = from_prefix_notation(a)
+        b_expr = parsed.get(b)
+        if b_expr is None:
+            b_expr = parsed[b] = from_prefix_notation(b)
+
+        records.append((a_expr, b_expr, d, t))
+    return records
+
+
 class Reader(object):
 
-    def __init__(self, file_name):
+    def __init__(self, file_name, block_size=DEFAULT_BLOCK_SIZE):
         self.file_name = file_name
+        self.block_size = block_size
         self.count = None
 
     def get_count(self):
@@ -17,19 +62,13 @@ class Reader(object):
         return self.count
 
     def entries(self):
-        for line in open(self.file_name):
-            [d, a, b, ms] = line[:-1].split(" ; ")
-            ts = ms.split(" , ")
-            try:
-                t = transformations.index(ts[0])
-            except:
-                t = None
-            d = int(d)
-            if d < 0:
-                d = None
-            a = from_prefix_notation(a)
-            b = from_prefix_notation(b)
-            yield (a, b, d, t)
+        with open(self.file_name) as f:
+            while True:
+                block = f.readlines(self.block_size)
+                if not block:
+                    break
+                for entry in parse_records(block):
+                    yield entry
 
     def batch_entries(self, batch_size):
         batch_as = []
@@ -1,116 +1,877 @@
 # Copyright 2018 EPFL.
 
+from collections import deque
 from heapq import *
+import math
+import queue
 import random
+import threading
+from timeit import default_timer
 
 from nugget.expressions import *
+from nugget.history import CSV_HEADER, NullHistory, csv_line
+from nugget.openlist import HeapOpenList, TimedOpenList
+from nugget.utils import BudgetExhausted, LRUCache
+from nugget.zipper import Zipper, expand, expand_backward, mask_classifications
 
-def history_to_csv(history):
-    lines = []
-    lines.append(','.join(['id','expr','estimatedDistance','action','parentId']))
-    for (expr_id, expr, estimated_distance, action, parent_id) in history:
-        lines.append(','.join([
-            str(expr_id),
-            str(expr),
-            str(estimated_distance) if estimated_distance is not None else '',
-            action if action is not None else '',
-            str(parent_id) if parent_id is not None else '']))
+def history_to_csv(history, codec=None):
+    lines = [CSV_HEADER]
+    lines.extend(csv_line(entry, codec) for entry in history)
     return '\n'.join(lines)
 
-def best_first_search(from_expr, to_expr, heuristics, factor=0.0):
+def state_keys(codec=None, stats=None):
+    """Return the functions used to key visited sets on states.
+
+    Args:
+        codec: Codec used to pack the states, or None to key
+            visited sets directly on states.
+        stats: If given, SearchStats in whose `hashing` phase
+            the time spent in both functions is added.
+
+    Returns:
+        The function converting states to keys,
+        and the function converting keys back to states.
+    """
+
+    if codec is None:
+        identity = lambda state: state
+        (pack, unpack) = (identity, identity)
+    else:
+        (pack, unpack) = (codec.pack, codec.unpack_state)
+
+    if stats is not None:
+        pack = stats.timed('hashing', pack)
+        unpack = stats.timed('hashing', unpack)
+    return (pack, unpack)
+
+def successor_functions(stats=None):
+    """Return the functions generating the neighbours of states.
+
+    Args:
+        stats: If given, SearchStats in whose `successors` phase
+            the time spent in the functions is added.
+
+    Returns:
+        The functions `expand` and `expand_backward`, and the dictionary
+        of the function of each transformation.
+    """
+
+    if stats is None:
+        return (expand, expand_backward, transformations_functions)
+
+    functions = dict((t, stats.timed('successors', f))
+                     for (t, f) in transformations_functions.items())
+    return (stats.timed('successors', expand),
+            stats.timed('successors', expand_backward),
+            functions)
+
+def estimator(with_target, target, stats=None, budget=None):
+    """Return the function estimating states towards a target.
+
+    Args:
+        with_target: Method of the heuristics building the function,
+            such as `with_target` or `with_target_batch`.
+        target: The target expression.
+        stats: If given, SearchStats in which the calls are counted
+            and timed. The heuristics must then accept stats.
+        budget: If given, Budget in which the calls are counted.
+    """
+
+    if stats is None:
+        h = with_target(target)
+    else:
+        h = stats.counted_heuristics(with_target(target, stats))
+    if budget is not None:
+        h = budget.counted(h)
+    return h
+
+def reconstruct_path(parents, key, codec=None):
+    """Follow the parent links back from a state.
+
+    Args:
+        parents: Dictionary mapping keys of states to
+            the key of their parent and the applied action.
+        key: The key of the last state of the path.
+        codec: Codec used to pack the keys, if any.
+
+    Returns:
+        The path of expressions leading to the state,
+        and the list of actions along it.
+    """
+
+    to_expr = codec.unpack if codec is not None else lambda s: s.to_expr()
+    path = [to_expr(key)]
+    actions = []
+    (key, action) = parents[key]
+    while key is not None:
+        path.append(to_expr(key))
+        actions.append(action)
+        (key, action) = parents[key]
+    path.reverse()
+    actions.reverse()
+    return (path, actions)
+
+def reconstruct_bidirectional_path(forward, backward, key, codec=None):
+    """Join the two halves of a path found by a bidirectional search.
+
+    Args:
+        forward: Dictionary mapping keys of states reached from the source
+            to the key of their parent and the applied action.
+        backward: Dictionary mapping keys of states reached from the target
+            to the key of their successor towards the target and the action
+            leading to it.
+        key: The key of a state reached from both ends.
+        codec: Codec used to pack the keys, if any.
+
+    Returns:
+        The path of expressions from the source to the target,
+        and the list of actions along it.
+    """
+
+    to_expr = codec.unpack if codec is not None else lambda s: s.to_expr()
+    (path, actions) = reconstruct_path(forward, key, codec)
+    (key, action) = backward[key]
+    while key is not None:
+        path.append(to_expr(key))
+        actions.append(action)
+        (key, action) = backward[key]
+    return (path, actions)
+
+def target_keys(to_exprs, pack):
+    """Map the keys of many target expressions to their indices.
+
+    Args:
+        to_exprs: The list of target expressions.
+        pack: The function converting states to keys.
+
+    Returns:
+        dict: The list of the indices of the targets of each key.
+    """
+
+    targets = {}
+    for (i, to_expr) in enumerate(to_exprs):
+        targets.setdefault(pack(Zipper.from_expr(to_expr)), []).append(i)
+    return targets
+
+def reach_targets(targets, results, parents, key, codec=None):
+    """Record the path to a state for the targets it matches, if any.
+
+    Args:
+        targets: Dictionary of the targets not reached yet,
+            as returned by `target_keys`. Those reached are removed.
+        results: List of the (path, actions) pair of each target.
+        parents: Dictionary mapping keys of states to
+            the key of their parent and the applied action.
+        key: The key of the state reached.
+        codec: Codec used to pack the keys, if any.
+
+    Returns:
+        bool: Whether the state is one of the targets.
+    """
+
+    indices = targets.pop(key, None)
+    if indices is None:
+        return False
+    result = reconstruct_path(parents, key, codec)
+    for i in indices:
+        results[i] = result
+    return True
+
+def rank_transformations(classes, mask):
+    """Order the applicable transformations by classifier score.
+
+    Args:
+        classes: Scores of the transformations, as output by the heuristics.
+        mask: Applicability mask of the state.
+
+    Returns:
+        list: Indices of the applicable transformations,
+        the most likely one last.
+    """
+
+    ranked = list(zip(mask_classifications(classes, mask),
+                      range(0, len(transformations))))
+    ranked.sort()
+    return [t for (_, t) in ranked if mask & (1 << t)]
+
+def best_first_search(from_expr, to_expr, heuristics, factor=0.0,
+                      codec=None, batch_children=False,
+                      open_list=HeapOpenList, budget=None, stats=None,
+                      history=None):
+    """Best-first search guided by the heuristics.
+
+    Args:
+        from_expr: The source expression.
+        to_expr: The target expression.
+        heuristics: The heuristics, providing `with_target`.
+        factor: Penalty per unit of depth added to the estimated distances.
+        codec: Codec used to pack the visited states, if any.
+        batch_children: If ``True``, the first time a state is expanded,
+            all its unvisited successors are estimated in a single call
+            to the heuristics. They are still generated one by one, in
+            the order of the classifier ranking. The expansion order is
+            that of single calls only if the heuristics give the same
+            estimates regardless of the batch. The network does not:
+            estimates may differ in the last bits, enough to break ties
+            differently.
+        open_list: Function returning the empty open list to use.
+        budget: If given, Budget limiting the resources of the search.
+        stats: If given, SearchStats in which the search is measured.
+        history: If given, sink receiving the history of the search,
+            such as those of `nugget.history`, returned instead of a list.
+
+    Returns:
+        The path of expressions from the source to the target,
+        the list of actions along it, and the history of the search,
+        or a BudgetExhausted result if the budget ran out first.
+    """
+
     if from_expr == to_expr:
         return ([from_expr], [], [])
 
-    h = heuristics.with_target(to_expr)
+    (pack, _) = state_keys(codec, stats)
+    (expand_state, _, functions) = successor_functions(stats)
+    h = estimator(heuristics.with_target, to_expr, stats, budget)
+
+    def estimate_children(state):
+        (successors, _) = expand_state(state)
+        if stats is not None:
+            stats.count('generated', len(successors))
+        children = {}
+        for (t, successor) in successors:
+            key = pack(successor)
+            if key not in parents:
+                children[t] = (successor, key)
+            elif stats is not None:
+                stats.count('duplicates')
+        if children:
+            ts = list(children)
+            (ds, tss) = h([children[t][0].to_expr() for t in ts])
+            for (t, d, classes) in zip(ts, ds, tss):
+                children[t] += ((d, classes),)
+        return children
+
+    from_state = Zipper.from_expr(from_expr)
+    from_key = pack(from_state)
+    to_key = pack(Zipper.from_expr(to_expr))
 
     # Building the entry of the first expression.
     (d, ts) = h(from_expr)
-    ts = list(zip(ts, range(0, len(transformations))))
-    ts.sort()
-    ts = [t for (_, t) in ts]
+    ts = rank_transformations(ts, from_state.applicable())
 
-    parents = { from_expr: (None, None) }
-    to_visit = [(d, from_expr, 0, ts)]
+    parents = { from_key: (None, None) }
+    to_visit = open_list()
+    if stats is not None:
+        to_visit = TimedOpenList(to_visit, stats)
+    to_visit.push(d, (from_state, 0, ts, from_key))
 
     # For logging purposes.
-    ids = { from_expr: 0 }
-    history = [(0, from_expr, d, None, None)]
+    ids = { from_key: 0 }
+    if history is None:
+        history = []
+    history.append((0, from_key, d, None, None))
     next_id = 1
 
+    # Estimates of the successors of the states being expanded,
+    # when estimated all at once.
+    estimated = {}
+
+    # Keys of the states being expanded, counted once by the budget.
+    expanding = set()
+
     while to_visit:
-        (current_estimated_distance, current_expr, current_depth, current_children) = to_visit[0]
+        (current_estimated_distance, (current_expr, current_depth, current_children, current_key)) = to_visit.peek()
+        if budget is not None and current_key not in expanding:
+            if budget.step(len(parents)):
+                return budget.result(history)
+            expanding.add(current_key)
+
         if current_children:
             transformation = transformations[current_children.pop()]
-            next_children = transformations_functions[transformation](current_expr)
             next_depth = current_depth + 1
 
+            if batch_children:
+                if current_key not in estimated:
+                    estimated[current_key] = estimate_children(current_expr)
+                (next_children, next_key, estimate) = \
+                    estimated[current_key].get(transformation, (None, None, None))
+            else:
+                next_children = functions[transformation](current_expr)
+                if next_children is not None:
+                    next_key = pack(next_children)
+                    if stats is not None:
+                        stats.count('generated')
+
             if next_children is not None:
-                if next_children not in parents:  # Checking that the expr was not already visited.
-                    parents[next_children] = (current_expr, transformation)
+                if next_key in parents:
+                    if stats is not None:
+                        stats.count('duplicates')
+                else:  # The expr was not already visited.
+                    parents[next_key] = (current_key, transformation)
 
-                    (d, ts) = h(next_children)
+                    if batch_children:
+                        (d, ts) = estimate
+                    else:
+                        (d, ts) = h(next_children.to_expr())
 
-                    history.append((next_id, next_children, d, transformation, ids[current_expr]))
-                    ids[next_children] = next_id
+                    history.append((next_id, next_key, d, transformation, ids[current_key]))
+                    ids[next_key] = next_id
                     next_id += 1
 
-                    if next_children == to_expr:  # Checking if we reached the target expression.
+                    if next_key == to_key:  # Checking if we reached the target expression.
                         break
 
-                    ts = list(zip(ts, range(0, len(transformations))))
-                    ts.sort()
-                    ts = [t for (_, t) in ts]
+                    ts = rank_transformations(ts, next_children.applicable())
 
-                    heappush(to_visit, (d + next_depth * factor, next_children, next_depth, ts))
+                    to_visit.push(d + next_depth * factor, (next_children, next_depth, ts, next_key))
         else:
-            heappop(to_visit)
+            to_visit.pop()
+            expanding.discard(current_key)
+            estimated.pop(current_key, None)
+            if stats is not None:
+                stats.count('expanded')
 
-    path = [to_expr]
-    actions = []
-    current_expr = to_expr
-    while current_expr is not None:
-        (current_expr, action) = parents[current_expr]
-        if current_expr is not None:
-            path.insert(0, current_expr)
-            actions.insert(0, action)
+    (path, actions) = reconstruct_path(parents, to_key, codec)
+    return (path, actions, history)
+
+
+def focal_search(from_expr, to_expr, heuristics, weight=1.0,
+                 focal_width=1.0, codec=None, budget=None, stats=None,
+                 history=None):
+    """Weighted A* search with a focal list.
+
+    States are ranked by `g + weight * h`, where `g` is the length of the
+    shortest known path to them and `h` their estimated distance to the
+    target. Among the open states whose rank is within `focal_width` times
+    the lowest rank, the focal list, the state reached by the transformation
+    its parent's classifier preferred is expanded first, then the one
+    closest to the target. States reached again by a shorter path are
+    reopened.
+
+    With an admissible heuristic, the path found is at most
+    `weight * focal_width` times longer than a shortest path.
+
+    Args:
+        from_expr: The source expression.
+        to_expr: The target expression.
+        heuristics: The heuristics, providing `with_target`.
+        weight (float): Weight of the estimated distances.
+        focal_width (float): Suboptimality tolerated by the focal list,
+            at least 1.
+        codec: Codec used to pack the visited states, if any.
+        budget: If given, Budget limiting the resources of the search.
+        stats: If given, SearchStats in which the search is measured,
+            including the number of `reopened` states.
+        history: If given, sink receiving the history of the search,
+            such as those of `nugget.history`, returned instead of a list.
+
+    Returns:
+        The path of expressions from the source to the target,
+        the list of actions along it, and the history of the search,
+        None if the target could not be reached, or a BudgetExhausted
+        result if the budget ran out first.
+    """
+
+    if focal_width < 1:
+        raise ValueError("Focal width below 1: {}".format(focal_width))
+
+    if stats is not None:
+        stats.count('reopened', 0)
+
+    if from_expr == to_expr:
+        return ([from_expr], [], [])
+
+    (pack, _) = state_keys(codec, stats)
+    (expand_state, _, _) = successor_functions(stats)
+    h = estimator(heuristics.with_target, to_expr, stats, budget)
+    (push, pop) = (heappush, heappop)
+    if stats is not None:
+        push = stats.timed('open_list', heappush)
+        pop = stats.timed('open_list', heappop)
+
+    from_state = Zipper.from_expr(from_expr)
+    from_key = pack(from_state)
+    to_key = pack(Zipper.from_expr(to_expr))
+
+    (d, ts) = h(from_expr)
 
+    parents = { from_key: (None, None) }
+    costs = { from_key: 0 }
+    closed = set()
+
+    # Open entries, by log identifier. Entries are deleted once expanded
+    # or superseded, leaving stale identifiers in the heaps below.
+    entries = { 0: (weight * d, 0, d, from_state, 0, ts, from_key) }
+    latest = { from_key: 0 }
+
+    # All open entries by rank, the entries of the focal list
+    # by preference, and the others by rank.
+    ranks = [(weight * d, 0)]
+    focal = [(0, d, 0)]
+    pending = []
+
+    # For logging purposes.
+    if history is None:
+        history = []
+    history.append((0, from_key, d, None, None))
+    next_id = 1
+
+    while True:
+        while ranks and ranks[0][1] not in entries:
+            pop(ranks)
+        if not ranks:
+            return None
+        bound = focal_width * ranks[0][0]
+
+        while pending and pending[0][0] <= bound:
+            (_, entry_id) = pop(pending)
+            if entry_id in entries:
+                (_, preference, d, _, _, _, _) = entries[entry_id]
+                push(focal, (preference, d, entry_id))
+
+        while True:
+            (_, _, current_id) = pop(focal)
+            if current_id not in entries:
+                continue
+            entry = entries[current_id]
+            if entry[0] > bound:
+                push(pending, (entry[0], current_id))
+                continue
+            break
+
+        (_, _, _, current_state, current_cost, current_ts, current_key) = \
+            entries.pop(current_id)
+        del latest[current_key]
+
+        if current_key == to_key:
+            break
+
+        if budget is not None and budget.step(len(costs)):
+            return budget.result(history)
+
+        closed.add(current_key)
+        (successors, mask) = expand_state(current_state)
+        if stats is not None:
+            stats.count('expanded')
+            stats.count('generated', len(successors))
+
+        ranked = rank_transformations(current_ts, mask)
+        preferences = {}
+        for (i, t) in enumerate(reversed(ranked)):
+            preferences[transformations[t]] = i
+
+        next_cost = current_cost + 1
+        children = []
+        for (transformation, next_state) in successors:
+            next_key = pack(next_state)
+            if next_key in costs and costs[next_key] <= next_cost:
+                if stats is not None:
+                    stats.count('duplicates')
+                continue
+
+            if next_key in closed:
+                closed.remove(next_key)
+                if stats is not None:
+                    stats.count('reopened')
+
+            costs[next_key] = next_cost
+            parents[next_key] = (current_key, transformation)
+            children.append((transformation, next_state, next_key))
+
+        if not children:
+            continue
+
+        (ds, tss) = h([s.to_expr() for (_, s, _) in children])
+        for ((transformation, next_state, next_key), d, ts) in \
+                zip(children, ds, tss):
+            history.append((next_id, next_key, d, transformation, current_id))
+
+            entries.pop(latest.get(next_key), None)
+            latest[next_key] = next_id
+            rank = next_cost + weight * d
+            preference = preferences[transformation]
+            entries[next_id] = (rank, preference, d, next_state, next_cost,
+                                ts, next_key)
+            push(ranks, (rank, next_id))
+            if rank <= bound:
+                push(focal, (preference, d, next_id))
+            else:
+                push(pending, (rank, next_id))
+            next_id += 1
+
+    (path, actions) = reconstruct_path(parents, to_key, codec)
     return (path, actions, history)
 
+def bidirectional_best_first_search(from_expr, to_expr, heuristics,
+                                    factor=0.0, codec=None, budget=None,
+                                    stats=None, history=None):
+    """Best-first search growing frontiers from both expressions.
 
-def batch_best_first_search(from_expr, to_expr, heuristics,
-                            factor=0.0, batch_size=32):
+    States reached from either end are ranked by the distance between their
+    embedding and the nearest embedding of the states on the frontier of
+    the other end, those reached but not expanded yet. As the frontiers
+    move, the best state is scored again before being expanded, and put
+    back in its open list if its distance grew. The search repeatedly
+    expands the best state of the smaller open list, forwards from the
+    source or backwards from the target, and stops as soon as the two
+    sides touch.
+
+    In the history, states reached from the target have as parent the state
+    they lead to, and as action the transformation leading to it.
+
+    When a budget is given and runs out, a BudgetExhausted result
+    is returned. When SearchStats are given, the search is measured
+    in them, the calls to the heuristics being those computing embeddings.
+    """
 
     if from_expr == to_expr:
         return ([from_expr], [], [])
 
-    h = heuristics.with_target_batch(to_expr)
+    (pack, _) = state_keys(codec, stats)
+    (expand_state, expand_state_backward, _) = successor_functions(stats)
+    embed = heuristics.embed
+    (push, pop) = (heappush, heappop)
+    if stats is not None:
+        embed = stats.counted_heuristics(
+            lambda exprs: heuristics.embed(exprs, stats))
+        push = stats.timed('open_list', heappush)
+        pop = stats.timed('open_list', heappop)
+    if budget is not None:
+        embed = budget.counted(embed)
+
+    from_state = Zipper.from_expr(from_expr)
+    to_state = Zipper.from_expr(to_expr)
+    from_key = pack(from_state)
+    to_key = pack(to_state)
+
+    forward = { from_key: (None, None) }
+    backward = { to_key: (None, None) }
+
+    # Embeddings of the states of each frontier.
+    embeddings = embed([from_expr, to_expr]).detach()
+    forward_embeddings = heuristics.embedding_set()
+    forward_embeddings.add(embeddings[0:1], [from_key])
+    backward_embeddings = heuristics.embedding_set()
+    backward_embeddings.add(embeddings[1:2], [to_key])
+    d = list(forward_embeddings.nearest_distances(embeddings[1:2]).data)[0]
+
+    # Entries are ordered by priority, then by log identifier. They hold
+    # the embedding of the state and the revision of the other frontier
+    # against which it was scored.
+    forward_open = [(d, 0, from_state, 0, embeddings[0:1],
+                     backward_embeddings.revision)]
+    backward_open = [(d, 1, to_state, 0, embeddings[1:2],
+                      forward_embeddings.revision)]
+
+    # For logging purposes.
+    if history is None:
+        history = []
+    history.append((0, from_key, d, None, None))
+    history.append((1, to_key, d, None, None))
+    next_id = 2
+
+    while forward_open and backward_open:
+        if len(forward_open) <= len(backward_open):
+            (to_visit, visited, others, own_embeddings, other_embeddings,
+             expand) = (forward_open, forward, backward,
+                        forward_embeddings, backward_embeddings,
+                        lambda state: expand_state(state)[0])
+        else:
+            (to_visit, visited, others, own_embeddings, other_embeddings,
+             expand) = (backward_open, backward, forward,
+                        backward_embeddings, forward_embeddings,
+                        expand_state_backward)
+
+        entry = pop(to_visit)
+        (priority, current_id, current_state, current_depth,
+         current_embedding, revision) = entry
+
+        # Scoring the state again if the other frontier moved since.
+        if revision != other_embeddings.revision:
+            d = list(other_embeddings.nearest_distances(
+                current_embedding).data)[0]
+            current_priority = d + current_depth * factor
+            if current_priority > priority:
+                push(to_visit, (current_priority, current_id, current_state,
+                    current_depth, current_embedding,
+                    other_embeddings.revision))
+                continue
+
+        if budget is not None and budget.step(len(forward) + len(backward)):
+            return budget.result(history)
+
+        current_key = pack(current_state)
+        own_embeddings.remove(current_key)
+        neighbours = expand(current_state)
+        next_depth = current_depth + 1
+
+        if stats is not None:
+            stats.count('expanded')
+            stats.count('generated', len(neighbours))
+
+        children = []
+        for (transformation, next_state) in neighbours:
+            next_key = pack(next_state)
+            if next_key in visited:
+                if stats is not None:
+                    stats.count('duplicates')
+                continue
+
+            visited[next_key] = (current_key, transformation)
+
+            if next_key in others:  # Checking if the frontiers touch.
+                history.append((next_id, next_key, None, transformation, current_id))
+                (path, actions) = reconstruct_bidirectional_path(
+                    forward, backward, next_key, codec)
+                return (path, actions, history)
+
+            children.append((transformation, next_state, next_key))
+
+        if not children:
+            continue
+
+        embeddings = embed(
+            [s.to_expr() for (_, s, _) in children]).detach()
+        ds = list(other_embeddings.nearest_distances(embeddings).data)
+        own_embeddings.add(embeddings, [k for (_, _, k) in children])
+
+        for (i, ((transformation, next_state, next_key), d)) in \
+                enumerate(zip(children, ds)):
+            history.append((next_id, next_key, d, transformation, current_id))
+            push(to_visit, (d + next_depth * factor, next_id, next_state,
+                next_depth, embeddings[i:i + 1], other_embeddings.revision))
+            next_id += 1
+
+
+def multi_target_best_first_search(from_expr, to_exprs, heuristics,
+                                   factor=0.0, codec=None, all_targets=True,
+                                   open_list=HeapOpenList, budget=None,
+                                   stats=None, history=None):
+    """Best-first search from one expression towards many targets.
+
+    A single visited set and open list are grown from the source, and
+    new states are looked up among the keys of the targets. All unvisited
+    successors of a state are estimated towards all targets in a single
+    call to `with_targets`. States are ranked by their smallest estimated
+    distance to a target not reached yet, plus the depth penalty. As
+    targets are reached, the priorities of the states left in the open
+    list are raised when they are popped.
+
+    Args:
+        from_expr: The source expression.
+        to_exprs: The list of target expressions.
+        heuristics: The heuristics, providing `with_targets`.
+        factor: Penalty per unit of depth added to the estimated distances.
+        codec: Codec used to pack the visited states, if any.
+        all_targets: Whether to search until all targets are reached,
+            rather than until the first one is.
+        open_list: Function returning the empty open list to use.
+        budget: If given, Budget limiting the resources of the search.
+        stats: If given, SearchStats in which the search is measured.
+        history: If given, sink receiving the history of the search,
+            such as those of `nugget.history`, returned instead of a list.
+
+    Returns:
+        The list holding, for each target, the path of expressions
+        and the list of actions leading to it, or None if it was not
+        reached, and the history of the search. The searched space is
+        exhausted, or the budget ran out, when targets remain None.
+    """
+
+    (pack, _) = state_keys(codec, stats)
+    (expand_state, _, _) = successor_functions(stats)
+    h = estimator(heuristics.with_targets, to_exprs, stats, budget)
+
+    from_state = Zipper.from_expr(from_expr)
+    from_key = pack(from_state)
+
+    targets = target_keys(to_exprs, pack)
+    results = [None] * len(to_exprs)
+    parents = { from_key: (None, None) }
+
+    if history is None:
+        history = []
+    if not targets:
+        return (results, history)
+
+    # Indices of the targets not reached yet.
+    pending = list(range(len(to_exprs)))
+
+    def estimate(row, depth):
+        return min(row[i] for i in pending) + depth * factor
+
+    [row] = h([from_expr])
+    history.append((0, from_key, min(row), None, None))
+    next_id = 1
+
+    if reach_targets(targets, results, parents, from_key, codec):
+        if not targets or not all_targets:
+            return (results, history)
+        pending = sorted(i for indices in targets.values() for i in indices)
+
+    to_visit = open_list()
+    if stats is not None:
+        to_visit = TimedOpenList(to_visit, stats)
+    to_visit.push(estimate(row, 0), (0, from_state, 0, from_key, row))
+
+    while to_visit:
+        (priority, entry) = to_visit.pop()
+        (current_id, current_state, current_depth, current_key, row) = entry
+
+        # Targets reached since the state was pushed may raise its priority.
+        current_priority = estimate(row, current_depth)
+        if current_priority > priority:
+            to_visit.push(current_priority, entry)
+            continue
+
+        if budget is not None and budget.step(len(parents)):
+            break
+
+        (successors, _) = expand_state(current_state)
+        if stats is not None:
+            stats.count('expanded')
+            stats.count('generated', len(successors))
+
+        children = []
+        for (transformation, next_state) in successors:
+            next_key = pack(next_state)
+            if next_key in parents:
+                if stats is not None:
+                    stats.count('duplicates')
+            else:
+                parents[next_key] = (current_key, transformation)
+                children.append((transformation, next_state, next_key))
+        if not children:
+            continue
+
+        rows = h([next_state.to_expr() for (_, next_state, _) in children])
+        next_depth = current_depth + 1
+        for ((transformation, next_state, next_key), row) in \
+                zip(children, rows):
+            history.append((next_id, next_key, min(row[i] for i in pending),
+                transformation, current_id))
+
+            if reach_targets(targets, results, parents, next_key, codec):
+                if not targets or not all_targets:
+                    return (results, history)
+                pending = sorted(
+                    i for indices in targets.values() for i in indices)
+
+            to_visit.push(estimate(row, next_depth),
+                (next_id, next_state, next_depth, next_key, row))
+            next_id += 1
+
+    return (results, history)
+
+
+def batch_best_first_search(from_expr, to_expr, heuristics,
+                            factor=0.0, batch_size=32, codec=None,
+                            tuner=None, open_list=HeapOpenList, budget=None,
+                            stats=None, history=None):
+    """Best-first search estimating the states in batches.
+
+    Args:
+        from_expr: The source expression.
+        to_expr: The target expression.
+        heuristics: The heuristics, providing `with_target_batch`.
+        factor: Penalty per unit of depth added to the estimated distances.
+        batch_size: Number of states estimated at once.
+        codec: Codec used to pack the visited states, if any.
+        tuner: If given, BatchSizeTuner choosing the batch size instead,
+            informed of the time taken by each batch.
+        open_list: Function returning the empty open list to use.
+        budget: If given, Budget limiting the resources of the search.
+        stats: If given, SearchStats in which the search is measured.
+        history: If given, sink receiving the history of the search,
+            such as those of `nugget.history`, returned instead of a list.
+
+    Returns:
+        The path of expressions from the source to the target,
+        the list of actions along it, and the history of the search,
+        None if the target could not be reached, or a BudgetExhausted
+        result if the budget ran out first.
+    """
+
+    h = estimator(heuristics.with_target_batch, to_expr, stats, budget)
+    steps = batch_best_first_search_steps(from_expr, to_expr,
+        factor, batch_size, codec, tuner, open_list, budget, stats, history)
+
+    request = next(steps)
+    while isinstance(request, list):
+        start_time = default_timer()
+        ds = h(request)
+        if tuner is not None:
+            tuner.record(len(request), default_timer() - start_time)
+        request = steps.send(ds)
+    return request
+
+def batch_best_first_search_steps(from_expr, to_expr,
+                                  factor=0.0, batch_size=32, codec=None,
+                                  tuner=None, open_list=HeapOpenList,
+                                  budget=None, stats=None, history=None):
+    """Perform a batch best-first search, leaving the estimations to the caller.
+
+    The search is a generator. It yields lists of expressions whose distance
+    to the target must be estimated, and expects the list of estimated
+    distances to be sent back. Its last yielded value is the result
+    of the search: a (path, actions, history) tuple, None if the target
+    could not be reached, or a BudgetExhausted result.
+
+    When a tuner is given, the batch size it currently proposes is used
+    instead of `batch_size`. Recording the latencies is left to the caller.
+    When a budget or stats are given, counting the calls to the heuristics
+    is also left to the caller. The batches are recorded in the stats.
+    """
+
+    if from_expr == to_expr:
+        yield ([from_expr], [], [])
+        return
+
+    (pack, _) = state_keys(codec, stats)
+    (expand_state, _, _) = successor_functions(stats)
     threshold = batch_size - (len(transformations) / 2)
 
-    parents = { from_expr: (None, None) }
-    to_estimate = [(from_expr, 0, None, None)]
-    to_visit = []
+    from_state = Zipper.from_expr(from_expr)
+    from_key = pack(from_state)
+    to_key = pack(Zipper.from_expr(to_expr))
+
+    parents = { from_key: (None, None) }
+    to_estimate = [(from_state, 0, None, None, from_key)]
+    to_visit = open_list()
+    if stats is not None:
+        to_visit = TimedOpenList(to_visit, stats)
 
     # For logging purposes.
     ids = {}
-    history = []
+    if history is None:
+        history = []
     next_id = 0
 
     while to_estimate or to_visit:
 
+        if tuner is not None:
+            threshold = tuner.batch_size() - (len(transformations) / 2)
+
         if len(to_estimate) > threshold:
-            exprs = [x[0] for x in to_estimate]
-            ds = h(exprs)
-            for ((expr, depth, t, parent_id), d) in zip(to_estimate, ds):
-                heappush(to_visit, (d + depth * factor, (expr, depth, t, parent_id)))
-                ids[expr] = next_id
-                history.append((next_id, expr, d, t, parent_id))
+            exprs = [x[0].to_expr() for x in to_estimate]
+            if stats is not None:
+                stats.batch(len(exprs),
+                    tuner.batch_size() if tuner is not None else batch_size)
+            ds = yield exprs
+            for ((expr, depth, t, parent_id, key), d) in zip(to_estimate, ds):
+                to_visit.push(d + depth * factor, (expr, depth, t, parent_id, key))
+                ids[key] = next_id
+                history.append((next_id, key, d, t, parent_id))
                 next_id += 1
             to_estimate = []
 
         if not to_estimate:
             max_priority = None
             for i in range(max(round(threshold / len(transformations)), 1)):
-                (priority, entry) = heappop(to_visit)
+                if not to_visit:
+                    break
+
+                (priority, entry) = to_visit.pop()
                 to_estimate.append(entry)
 
                 if max_priority is None:
@@ -119,132 +880,1058 @@ def batch_best_first_search(from_expr, to_expr, heuristics,
                 if priority >= max_priority + 1:
                     break
 
-        (expr, depth, transformation, parent_id) = to_estimate.pop(0)
+            if not to_estimate:
+                break
+
+        if budget is not None and budget.step(len(parents)):
+            yield budget.result(history)
+            return
 
-        if expr not in ids:
-            ids[expr] = next_id
-            history.append((next_id, expr, None, transformation, parent_id))
+        (expr, depth, transformation, parent_id, key) = to_estimate.pop(0)
+
+        if key not in ids:
+            ids[key] = next_id
+            history.append((next_id, key, None, transformation, parent_id))
             next_id += 1
 
         child_depth = depth + 1
-        for t, f in transformations_functions.items():
-            child_expr = f(expr)
-            if child_expr is not None and not child_expr in parents:
-                to_estimate.append((child_expr, child_depth, t, ids[expr]))
-                parents[child_expr] = (expr, t)
-                if child_expr == to_expr:
-                    for (other_expr,
-                         other_depth,
+        (successors, _) = expand_state(expr)
+        if stats is not None:
+            stats.count('expanded')
+            stats.count('generated', len(successors))
+        for (t, child_expr) in successors:
+            child_key = pack(child_expr)
+            if child_key in parents:
+                if stats is not None:
+                    stats.count('duplicates')
+            else:
+                to_estimate.append((child_expr, child_depth, t, ids[key], child_key))
+                parents[child_key] = (key, t)
+                if child_key == to_key:
+                    for (_,
+                         _,
                          other_transformation,
-                         other_parent_id) in to_estimate:
+                         other_parent_id,
+                         other_key) in to_estimate:
 
-                        if other_expr not in ids:
-                            ids[other_expr] = next_id
+                        if other_key not in ids:
+                            ids[other_key] = next_id
                             history.append((
                                 next_id,
-                                other_expr,
+                                other_key,
                                 None,
                                 other_transformation,
                                 other_parent_id))
                             next_id += 1
 
-                    path = [to_expr]
-                    actions = []
-                    current_expr = to_expr
-                    while current_expr is not None:
-                        (current_expr, action) = parents[current_expr]
-                        if current_expr is not None:
-                            path.insert(0, current_expr)
-                            actions.insert(0, action)
+                    (path, actions) = reconstruct_path(parents, to_key, codec)
+                    yield (path, actions, history)
+                    return
+
+    yield None
+
+def pipelined_batch_best_first_search(from_expr, to_expr, heuristics,
+                                      factor=0.0, batch_size=32,
+                                      queue_size=1, codec=None, tuner=None,
+                                      open_list=HeapOpenList, budget=None,
+                                      stats=None, history=None):
+    """Batch best-first search estimating batches in a background thread.
+
+    As `batch_best_first_search`, except that full batches are handed to
+    a thread evaluating the heuristics, while the search goes on expanding
+    the states it already has. Estimated batches are merged into the open
+    list as they arrive. The search only waits for the thread when it has
+    nothing left to expand, or when a batch is full while `queue_size`
+    batches are already being estimated. Before returning, the search
+    waits for the thread to finish the batch it is estimating, if any.
+
+    Since states are expanded before all estimates are known, the order
+    of expansion, and thus the history, differ from those of
+    `batch_best_first_search`.
+
+    In the history, states still being estimated when the target is
+    found have no estimated distance.
+
+    When a tuner is given, it chooses the batch size instead of
+    `batch_size`, and is informed of the time taken by each batch.
+    When a budget is given and runs out, a BudgetExhausted result
+    is returned. When SearchStats are given, the search is measured in
+    them, the time spent in the heuristics being that of the thread.
+    """
+
+    if from_expr == to_expr:
+        return ([from_expr], [], [])
+
+    h = estimator(heuristics.with_target_batch, to_expr, stats, budget)
+    (pack, _) = state_keys(codec, stats)
+    (expand_state, _, _) = successor_functions(stats)
+    threshold = batch_size - (len(transformations) / 2)
+
+    from_state = Zipper.from_expr(from_expr)
+    from_key = pack(from_state)
+    to_key = pack(Zipper.from_expr(to_expr))
+
+    parents = { from_key: (None, None) }
+    to_estimate = [(from_state, 0, None, None, from_key)]
+    to_visit = open_list()
+    if stats is not None:
+        to_visit = TimedOpenList(to_visit, stats)
+
+    # For logging purposes.
+    ids = {}
+    if history is None:
+        history = []
+    next_id = 0
+
+    requests = queue.Queue()
+    responses = queue.Queue()
+
+    def estimate():
+        while True:
+            batch = requests.get()
+            if batch is None:
+                break
+            try:
+                start_time = default_timer()
+                ds = h([x[0].to_expr() for x in batch])
+                if tuner is not None:
+                    tuner.record(len(batch), default_timer() - start_time)
+            except Exception as exc:
+                responses.put((None, exc))
+                continue
+            responses.put((ds, None))
+
+    worker = threading.Thread(target=estimate)
+    worker.daemon = True
+    worker.start()
+    in_flight = deque()
+
+    try:
+        while to_estimate or to_visit or in_flight:
+
+            if tuner is not None:
+                threshold = tuner.batch_size() - (len(transformations) / 2)
+
+            # Merging the estimated batches, waiting for them when idle
+            # or when too many batches are being estimated.
+            while in_flight and (not responses.empty() or
+                                 not (to_estimate or to_visit) or
+                                 (len(to_estimate) > threshold and
+                                  len(in_flight) >= queue_size)):
+                (ds, error) = responses.get()
+                batch = in_flight.popleft()
+                if error is not None:
+                    raise error
+                for ((expr, depth, t, parent_id, key), d) in zip(batch, ds):
+                    to_visit.push(d + depth * factor, (expr, depth, t, parent_id, key))
+                    ids[key] = next_id
+                    history.append((next_id, key, d, t, parent_id))
+                    next_id += 1
+
+            if len(to_estimate) > threshold:
+                if stats is not None:
+                    stats.batch(len(to_estimate),
+                        tuner.batch_size() if tuner is not None else batch_size)
+                requests.put(to_estimate)
+                in_flight.append(to_estimate)
+                to_estimate = []
+
+            if not to_estimate:
+                max_priority = None
+                for i in range(max(round(threshold / len(transformations)), 1)):
+                    if not to_visit:
+                        break
+
+                    (priority, entry) = to_visit.pop()
+                    to_estimate.append(entry)
+
+                    if max_priority is None:
+                        max_priority = priority
+
+                    if priority >= max_priority + 1:
+                        break
+
+                if not to_estimate:
+                    continue
+
+            if budget is not None and budget.step(len(parents)):
+                return budget.result(history)
+
+            (expr, depth, transformation, parent_id, key) = to_estimate.pop(0)
+
+            if key not in ids:
+                ids[key] = next_id
+                history.append((next_id, key, None, transformation, parent_id))
+                next_id += 1
+
+            child_depth = depth + 1
+            (successors, _) = expand_state(expr)
+            if stats is not None:
+                stats.count('expanded')
+                stats.count('generated', len(successors))
+            for (t, child_expr) in successors:
+                child_key = pack(child_expr)
+                if child_key in parents:
+                    if stats is not None:
+                        stats.count('duplicates')
+                else:
+                    to_estimate.append((child_expr, child_depth, t, ids[key], child_key))
+                    parents[child_key] = (key, t)
+                    if child_key == to_key:
+                        # Recording the states not yet estimated.
+                        pending = [entry for batch in in_flight for entry in batch]
+                        pending.extend(to_estimate)
+                        for (_,
+                             _,
+                             other_transformation,
+                             other_parent_id,
+                             other_key) in pending:
+
+                            if other_key not in ids:
+                                ids[other_key] = next_id
+                                history.append((
+                                    next_id,
+                                    other_key,
+                                    None,
+                                    other_transformation,
+                                    other_parent_id))
+                                next_id += 1
+
+                        (path, actions) = reconstruct_path(parents, to_key, codec)
+                        return (path, actions, history)
+    finally:
+        # Cancelling the batches not yet picked up by the thread.
+        while True:
+            try:
+                requests.get_nowait()
+            except queue.Empty:
+                break
+        requests.put(None)
+        worker.join()
+
+    return None
+
+def batch_best_first_search_many(problems, heuristics, factor=0.0,
+                                 batch_size=32, max_batch_size=1024,
+                                 codec=None, open_list=HeapOpenList,
+                                 budget=None, stats=None):
+    """Perform many batch best-first searches concurrently.
+
+    The searches are interleaved, and the expressions they need estimated
+    are gathered into shared batches, each evaluated in a single call
+    to the network, with one target per row.
+
+    Args:
+        problems: List of (from_expr, to_expr) pairs.
+        heuristics: The Heuristics used to estimate distances.
+        factor: Depth penalty.
+        batch_size: Batch size of each individual search.
+        max_batch_size: Maximal number of expressions estimated at once.
+            Searches whose requests do not fit in a batch are served first
+            in the next one.
+        codec: Codec used to pack visited states, if any.
+        open_list: Function returning the empty open list of each search.
+        budget: If given, Budget shared by all searches. Once it runs out,
+            the searches not yet done are stopped.
+        stats: If given, SearchStats in which all searches are measured.
+
+    Returns:
+        list: The result of each search, in the order of the problems,
+        as returned by `batch_best_first_search`.
+    """
+
+    h = estimator(heuristics.with_targets_batch,
+        [to_expr for (_, to_expr) in problems], stats, budget)
+
+    results = [None] * len(problems)
+    pending = deque()
+    for (i, (from_expr, to_expr)) in enumerate(problems):
+        steps = batch_best_first_search_steps(from_expr, to_expr,
+            factor, batch_size, codec, open_list=open_list, budget=budget,
+            stats=stats)
+        request = next(steps)
+        if isinstance(request, list):
+            pending.append((i, steps, request))
+        else:
+            results[i] = request
+
+    while pending:
+        # Gathering the requests of as many searches as fit in the batch.
+        served = [pending.popleft()]
+        size = len(served[0][2])
+        while pending and size + len(pending[0][2]) <= max_batch_size:
+            served.append(pending.popleft())
+            size += len(served[-1][2])
+
+        sources = []
+        targets = []
+        for (i, _, request) in served:
+            sources.extend(request)
+            targets.extend([i] * len(request))
+        ds = h(sources, targets)
+
+        offset = 0
+        for (i, steps, request) in served:
+            request_ds = ds[offset:offset + len(request)]
+            offset += len(request)
+            request = steps.send(request_ds)
+            if isinstance(request, list):
+                pending.append((i, steps, request))
+            else:
+                results[i] = request
+
+    return results
+
+def beam_search(from_expr, to_expr, heuristics, beam_width=16,
+                top_transformations=3, max_depth=50, codec=None,
+                budget=None, stats=None, history=None):
+    """Beam search pruned by the transformation classifier.
+
+    At each depth, only the `beam_width` states of lowest estimated
+    distance are kept. Of each of them, only the successors by the
+    `top_transformations` applicable transformations the classifier ranks
+    highest are generated. All successors of a layer are estimated in
+    a single call to the heuristics.
+
+    Args:
+        from_expr: The source expression.
+        to_expr: The target expression.
+        heuristics: The heuristics, providing `with_target`.
+        beam_width (int): Number of states kept at each depth.
+        top_transformations (int): Number of transformations
+            applied to each state.
+        max_depth (int): Depth after which the search gives up.
+        codec: Codec used to pack the visited states, if any.
+        budget: If given, Budget limiting the resources of the search.
+        stats: If given, SearchStats in which the search is measured.
+        history: If given, sink receiving the history of the search,
+            such as those of `nugget.history`, returned instead of a list.
+
+    Returns:
+        The path of expressions from the source to the target,
+        the list of actions along it, and the history of the search,
+        None if the target was not reached within `max_depth` steps,
+        or a BudgetExhausted result if the budget ran out first.
+    """
+
+    if from_expr == to_expr:
+        return ([from_expr], [], [])
+
+    (pack, _) = state_keys(codec, stats)
+    (_, _, functions) = successor_functions(stats)
+    h = estimator(heuristics.with_target, to_expr, stats, budget)
+
+    from_state = Zipper.from_expr(from_expr)
+    from_key = pack(from_state)
+    to_key = pack(Zipper.from_expr(to_expr))
+
+    ([d], [ts]) = h([from_expr])
+
+    parents = { from_key: (None, None) }
+    beam = [(d, 0, from_state, ts)]
+
+    # For logging purposes.
+    if history is None:
+        history = []
+    history.append((0, from_key, d, None, None))
+    next_id = 1
+
+    for _ in range(max_depth):
+        children = []
+        for (_, current_id, current_state, current_ts) in beam:
+            if budget is not None and budget.step(len(parents)):
+                return budget.result(history)
+
+            current_key = pack(current_state)
+            ranked = rank_transformations(current_ts, current_state.applicable())
+            if stats is not None:
+                stats.count('expanded')
+            for t in reversed(ranked[-top_transformations:]):
+                transformation = transformations[t]
+                next_state = functions[transformation](current_state)
+                next_key = pack(next_state)
+                if stats is not None:
+                    stats.count('generated')
+                if next_key in parents:
+                    if stats is not None:
+                        stats.count('duplicates')
+                    continue
+                parents[next_key] = (current_key, transformation)
+
+                if next_key == to_key:
+                    history.append((next_id, next_key, None, transformation, current_id))
+                    (path, actions) = reconstruct_path(parents, to_key, codec)
                     return (path, actions, history)
 
-def breadth_first_search(from_expr, to_expr):
+                children.append((transformation, next_state, next_key, current_id))
+
+        if not children:
+            break
+
+        (ds, tss) = h([s.to_expr() for (_, s, _, _) in children])
+        beam = []
+        for ((transformation, next_state, next_key, current_id), d, ts) in \
+                zip(children, ds, tss):
+            history.append((next_id, next_key, d, transformation, current_id))
+            beam.append((d, next_id, next_state, ts))
+            next_id += 1
+
+        beam.sort(key=lambda entry: entry[:2])
+        del beam[beam_width:]
+
+    return None
+
+class MCTSNode(object):
+    """Node of the tree of `monte_carlo_tree_search`."""
+
+    __slots__ = ('state', 'key', 'id', 'parent_id', 'transformation',
+                 'visits', 'value_sum', 'estimate', 'successors', 'children')
+
+    def __init__(self, state, key, parent_id, transformation):
+        self.state = state
+        self.key = key
+        self.id = None
+        self.parent_id = parent_id
+        self.transformation = transformation
+        self.visits = 0
+        self.value_sum = 0.0
+        self.estimate = None
+
+        # List of (transformation, state, key, prior) of the successors,
+        # once the node is evaluated, and nodes of those already visited.
+        self.successors = None
+        self.children = {}
+
+    def value(self):
+        return self.value_sum / self.visits
+
+
+def remove_loops(path, actions, pack):
+    """Shorten a path by cutting the loops going through a state twice."""
+
+    positions = {}
+    kept_path = []
+    kept_actions = []
+    for (i, expr) in enumerate(path):
+        key = pack(expr)
+        if key in positions:
+            n = positions[key]
+            for other in kept_path[n + 1:]:
+                del positions[pack(other)]
+            del kept_path[n + 1:]
+            del kept_actions[n:]
+        else:
+            positions[key] = len(kept_path)
+            kept_path.append(expr)
+            if i > 0:
+                kept_actions.append(actions[i - 1])
+    return (kept_path, kept_actions)
+
+
+def monte_carlo_tree_search(from_expr, to_expr, heuristics,
+                            simulations=10000, batch_size=16,
+                            exploration=1.0, virtual_loss=1.0, codec=None,
+                            budget=None, stats=None, history=None):
+    """Monte Carlo tree search guided by the network.
+
+    Each simulation descends from the source, choosing at each node the
+    successor maximising `Q + exploration * P * sqrt(N) / (1 + n)`, where
+    `Q` is the mean value of the successor, `P` its prior, `N` the number
+    of visits of the node and `n` that of the successor. Priors are the
+    softmax of the classifier outputs over the applicable transformations,
+    and the value of a state is minus its estimated distance to the target.
+    Unvisited successors are valued as their parent.
+
+    The leaves reached by `batch_size` simulations are evaluated at once.
+    Virtual losses steer the simulations of a batch towards different
+    leaves. The tree grows by at most one node per simulation. A state may
+    appear in several nodes, but is estimated only once, and the loops of
+    the path found are removed.
+
+    Args:
+        from_expr: The source expression.
+        to_expr: The target expression.
+        heuristics: The heuristics, providing `with_target`.
+        simulations (int): Maximal number of simulations.
+        batch_size (int): Number of simulations per batch of evaluations.
+        exploration (float): Weight of the priors.
+        virtual_loss (float): Value subtracted from the nodes along
+            pending simulations.
+        codec: Codec used to pack the states, if any.
+        budget: If given, Budget limiting the resources of the search,
+            to which each simulation counts as an expansion.
+        stats: If given, SearchStats in which the search is measured.
+            The expanded states are the evaluated ones, and the
+            duplicates the leaves whose state was already evaluated.
+        history: If given, sink receiving the history of the search,
+            such as those of `nugget.history`, returned instead of a list.
+
+    Returns:
+        The path of expressions from the source to the target,
+        the list of actions along it, and the history of the search,
+        None if the target was not reached within the simulations,
+        or a BudgetExhausted result if the budget ran out first.
+    """
+
     if from_expr == to_expr:
         return ([from_expr], [], [])
 
-    parents = { from_expr: (None, None) }
-    queue = [from_expr]
+    (pack, _) = state_keys(codec, stats)
+    (expand_state, _, _) = successor_functions(stats)
+    h = estimator(heuristics.with_target, to_expr, stats, budget)
+
+    from_state = Zipper.from_expr(from_expr)
+    to_key = pack(Zipper.from_expr(to_expr))
+    root = MCTSNode(from_state, pack(from_state), None, None)
+
+    # Estimated distance and successors of each state.
+    estimates = {}
 
     # For logging purposes.
-    ids = { from_expr: 0 }
-    history = [(0, from_expr, None, None, None)]
+    if history is None:
+        history = []
+    next_id = 0
+
+    def evaluate(leaves):
+        missing = []
+        for leaf in leaves:
+            if leaf.key not in estimates:
+                estimates[leaf.key] = None
+                missing.append(leaf)
+            elif stats is not None:
+                stats.count('duplicates')
+
+        if missing:
+            (ds, tss) = h([leaf.state.to_expr() for leaf in missing])
+            for (leaf, d, ts) in zip(missing, ds, tss):
+                (successors, mask) = expand_state(leaf.state)
+                if stats is not None:
+                    stats.count('expanded')
+                    stats.count('generated', len(successors))
+                entries = []
+                if successors:
+                    scores = mask_classifications(ts, mask)
+                    highest = max(scores)
+                    weights = [math.exp(score - highest) for score in scores]
+                    total = sum(weights)
+                    for (t, successor) in successors:
+                        prior = weights[transformations.index(t)] / total
+                        entries.append((t, successor, pack(successor), prior))
+                estimates[leaf.key] = (d, entries)
+
+        for leaf in leaves:
+            (d, leaf.successors) = estimates[leaf.key]
+            leaf.estimate = -d
+
+    evaluate([root])
+    root.id = next_id
+    history.append((next_id, root.key, -root.estimate, None, None))
+    next_id += 1
+    root.visits = 1
+    root.value_sum = root.estimate
+
+    done = 0
+    while done < simulations:
+        paths = []
+        leaves = []
+        for _ in range(min(batch_size, simulations - done)):
+            if budget is not None and budget.step(len(estimates)):
+                break
+
+            node = root
+            path = [root]
+            actions = []
+            while node.successors:
+                scale = exploration * math.sqrt(node.visits)
+                best = None
+                for (t, successor, key, prior) in node.successors:
+                    child = node.children.get(t)
+                    if child is not None and child.visits > 0:
+                        score = child.value() + scale * prior / (1 + child.visits)
+                    else:
+                        score = node.value() + scale * prior
+                    if best is None or score > best[0]:
+                        best = (score, t, successor, key)
+
+                (_, t, successor, key) = best
+                child = node.children.get(t)
+                if child is None:
+                    child = MCTSNode(successor, key, node.id, t)
+                    node.children[t] = child
+
+                    if key == to_key:
+                        history.append((next_id, key, None, t, node.id))
+                        exprs = [n.state.to_expr() for n in path]
+                        exprs.append(successor.to_expr())
+                        actions.append(t)
+                        (exprs, actions) = remove_loops(exprs, actions,
+                            lambda e: pack(Zipper.from_expr(e)))
+                        return (exprs, actions, history)
+
+                path.append(child)
+                actions.append(t)
+                node = child
+
+            for n in path:
+                n.visits += 1
+                n.value_sum -= virtual_loss
+            paths.append(path)
+            if node.successors is None and node not in leaves:
+                leaves.append(node)
+        done += len(paths)
+        if not paths:
+            # The budget ran out.
+            return budget.result(history)
+
+        if leaves:
+            evaluate(leaves)
+            for leaf in leaves:
+                leaf.id = next_id
+                history.append((next_id, leaf.key, -leaf.estimate, leaf.transformation, leaf.parent_id))
+                next_id += 1
+
+        # Replacing the virtual losses by the values of the leaves.
+        for path in paths:
+            value = path[-1].estimate
+            for n in path:
+                n.value_sum += virtual_loss + value
+
+    return None
+
+def breadth_first_search(from_expr, to_expr, codec=None, budget=None,
+                         stats=None, history=None):
+    if from_expr == to_expr:
+        return ([from_expr], [], [])
+
+    (pack, unpack) = state_keys(codec, stats)
+    (expand_state, _, _) = successor_functions(stats)
+
+    from_key = pack(Zipper.from_expr(from_expr))
+    to_key = pack(Zipper.from_expr(to_expr))
+
+    parents = { from_key: (None, None) }
+
+    # The frontier holds the keys of the states and their log identifiers.
+    frontier = deque([(from_key, 0)])
+
+    # For logging purposes.
+    if history is None:
+        history = []
+    history.append((0, from_key, None, None, None))
     next_id = 1
 
-    while queue:
-        current_expr = queue.pop()
+    while frontier:
+        if budget is not None and budget.step(len(parents)):
+            return budget.result(history)
+
+        (current_key, current_id) = frontier.pop()
 
-        for transformation in transformations:
-            next_expr = transformations_functions[transformation](current_expr)
-            if next_expr is not None and not next_expr in parents:
-                parents[next_expr] = (current_expr, transformation)
+        (successors, _) = expand_state(unpack(current_key))
+        if stats is not None:
+            stats.count('expanded')
+            stats.count('generated', len(successors))
+        for (transformation, next_expr) in successors:
+            next_key = pack(next_expr)
+            if next_key in parents:
+                if stats is not None:
+                    stats.count('duplicates')
+            else:
+                parents[next_key] = (current_key, transformation)
 
-                ids[next_expr] = next_id
-                history.append((next_id, next_expr, None, transformation, ids[current_expr]))
+                history.append((next_id, next_key, None, transformation, current_id))
+                frontier.appendleft((next_key, next_id))
                 next_id += 1
-                queue.insert(0, next_expr)
-
-                if next_expr == to_expr:
-                    path = [to_expr]
-                    actions = []
-                    current_expr = to_expr
-                    while current_expr is not None:
-                        (current_expr, action) = parents[current_expr]
-                        if current_expr is not None:
-                            path.insert(0, current_expr)
-                            actions.insert(0, action)
 
+                if next_key == to_key:
+                    (path, actions) = reconstruct_path(parents, to_key, codec)
                     return (path, actions, history)
 
-def iterative_depth_first_search(from_expr, to_expr, initial_max_depth=1):
+def bidirectional_breadth_first_search(from_expr, to_expr, codec=None,
+                                       budget=None, stats=None, history=None):
+    """Breadth-first search growing frontiers from both expressions.
+
+    The smallest of the two frontiers is expanded one full layer at a time,
+    forwards from the source or backwards from the target, until they meet.
+    The returned path is a shortest one.
+
+    In the history, states reached from the target have as parent the state
+    they lead to, and as action the transformation leading to it.
+
+    When a budget is given and runs out, a BudgetExhausted result
+    is returned. When SearchStats are given, the search is measured
+    in them.
+    """
+
+    if from_expr == to_expr:
+        return ([from_expr], [], [])
+
+    (pack, unpack) = state_keys(codec, stats)
+    (expand_state, expand_state_backward, _) = successor_functions(stats)
+
+    from_key = pack(Zipper.from_expr(from_expr))
+    to_key = pack(Zipper.from_expr(to_expr))
+
+    forward = { from_key: (None, None) }
+    backward = { to_key: (None, None) }
+
+    # Frontiers hold the keys of the states along with their log identifier.
+    forward_frontier = [(from_key, 0)]
+    backward_frontier = [(to_key, 1)]
+
+    # For logging purposes.
+    if history is None:
+        history = []
+    history.append((0, from_key, None, None, None))
+    history.append((1, to_key, None, None, None))
+    next_id = 2
+
+    while forward_frontier and backward_frontier:
+        is_forward = len(forward_frontier) <= len(backward_frontier)
+        if is_forward:
+            (frontier, visited, others, neighbours) = \
+                (forward_frontier, forward, backward,
+                 lambda s: expand_state(s)[0])
+        else:
+            (frontier, visited, others, neighbours) = \
+                (backward_frontier, backward, forward, expand_state_backward)
+
+        next_frontier = []
+        best = None
+        for (current_key, current_id) in frontier:
+            if budget is not None and budget.step(len(forward) + len(backward)):
+                return budget.result(history)
+
+            successors = neighbours(unpack(current_key))
+            if stats is not None:
+                stats.count('expanded')
+                stats.count('generated', len(successors))
+            for (transformation, next_expr) in successors:
+                next_key = pack(next_expr)
+                if next_key in visited:
+                    if stats is not None:
+                        stats.count('duplicates')
+                    continue
+
+                visited[next_key] = (current_key, transformation)
+                history.append((next_id, next_key, None, transformation, current_id))
+                next_frontier.append((next_key, next_id))
+                next_id += 1
+
+                if next_key in others:
+                    # Meeting points found in the same layer may lie at
+                    # different depths of the other search.
+                    solution = reconstruct_bidirectional_path(
+                        forward, backward, next_key, codec)
+                    if best is None or len(solution[1]) < len(best[1]):
+                        best = solution
+
+        if best is not None:
+            return (best[0], best[1], history)
+
+        if is_forward:
+            forward_frontier = next_frontier
+        else:
+            backward_frontier = next_frontier
+
+def multi_target_breadth_first_search(from_expr, to_exprs, codec=None,
+                                      all_targets=True, budget=None,
+                                      stats=None, history=None):
+    """Breadth-first search from one expression towards many targets.
+
+    A single visited set and frontier are grown from the source, and
+    new states are looked up among the keys of the targets. Each state
+    is thus expanded once for all targets, and the paths found are
+    shortest ones.
+
+    Args:
+        from_expr: The source expression.
+        to_exprs: The list of target expressions.
+        codec: Codec used to pack the visited states, if any.
+        all_targets: Whether to search until all targets are reached,
+            rather than until the first one is.
+        budget: If given, Budget limiting the resources of the search.
+        stats: If given, SearchStats in which the search is measured.
+        history: If given, sink receiving the history of the search,
+            such as those of `nugget.history`, returned instead of a list.
+
+    Returns:
+        The list holding, for each target, the path of expressions
+        and the list of actions leading to it, or None if it was not
+        reached, and the history of the search. The searched space is
+        exhausted, or the budget ran out, when targets remain None.
+    """
+
+    (pack, unpack) = state_keys(codec, stats)
+    (expand_state, _, _) = successor_functions(stats)
+
+    from_key = pack(Zipper.from_expr(from_expr))
+
+    targets = target_keys(to_exprs, pack)
+    results = [None] * len(to_exprs)
+    parents = { from_key: (None, None) }
+
+    # The frontier holds the keys of the states and their log identifiers.
+    frontier = deque([(from_key, 0)])
+
+    # For logging purposes.
+    if history is None:
+        history = []
+    history.append((0, from_key, None, None, None))
+    next_id = 1
+
+    if not targets:
+        return (results, history)
+    if reach_targets(targets, results, parents, from_key, codec):
+        if not targets or not all_targets:
+            return (results, history)
+
+    while frontier:
+        if budget is not None and budget.step(len(parents)):
+            break
+
+        (current_key, current_id) = frontier.pop()
+
+        (successors, _) = expand_state(unpack(current_key))
+        if stats is not None:
+            stats.count('expanded')
+            stats.count('generated', len(successors))
+        for (transformation, next_expr) in successors:
+            next_key = pack(next_expr)
+            if next_key in parents:
+                if stats is not None:
+                    stats.count('duplicates')
+            else:
+                parents[next_key] = (current_key, transformation)
+
+                history.append((next_id, next_key, None, transformation, current_id))
+                frontier.appendleft((next_key, next_id))
+                next_id += 1
+
+                if reach_targets(targets, results, parents, next_key, codec):
+                    if not targets or not all_targets:
+                        return (results, history)
+
+    return (results, history)
+
+def iterative_depth_first_search(from_expr, to_expr, initial_max_depth=1,
+                                 codec=None, budget=None, stats=None,
+                                 history=None):
+    # A history given receives the entries of all iterations in turn.
     solution = None
     max_depth = initial_max_depth
     while solution is None:
-        solution = depth_first_search(from_expr, to_expr, max_depth)
+        solution = depth_first_search(from_expr, to_expr, max_depth, codec,
+            budget, stats, history)
         max_depth += 1
     return solution
 
-def depth_first_search(from_expr, to_expr, max_depth=None):
+def depth_first_search(from_expr, to_expr, max_depth=None, codec=None,
+                       budget=None, stats=None, history=None):
     if from_expr == to_expr:
         return ([from_expr], [], [])
 
-    parents = { from_expr: (None, None) }
-    stack = [from_expr]
+    (pack, unpack) = state_keys(codec, stats)
+    (expand_state, _, _) = successor_functions(stats)
+
+    from_key = pack(Zipper.from_expr(from_expr))
+    to_key = pack(Zipper.from_expr(to_expr))
+
+    parents = { from_key: (None, None) }
+    stack = [from_key]
 
-    depths = { from_expr: 0 }
+    depths = { from_key: 0 }
 
     # For logging purposes.
-    ids = { from_expr: 0 }
-    history = [(0, from_expr, None, None, None)]
+    ids = { from_key: 0 }
+    if history is None:
+        history = []
+    history.append((0, from_key, None, None, None))
     next_id = 1
 
     while stack:
-        current_expr = stack.pop()
-        current_depth = depths[current_expr]
+        if budget is not None and budget.step(len(parents)):
+            return budget.result(history)
 
-        for transformation in transformations:
-            next_expr = transformations_functions[transformation](current_expr)
-            next_depth = current_depth + 1
-            if next_expr is not None and (next_expr not in parents or depths[next_expr] > next_expr):
+        current_key = stack.pop()
+        current_depth = depths[current_key]
+
+        next_depth = current_depth + 1
+        (successors, _) = expand_state(unpack(current_key))
+        if stats is not None:
+            stats.count('expanded')
+            stats.count('generated', len(successors))
+        for (transformation, next_expr) in successors:
+            next_key = pack(next_expr)
+            if next_key in parents and depths[next_key] <= next_depth:
+                if stats is not None:
+                    stats.count('duplicates')
+            else:
 
-                parents[next_expr] = (current_expr, transformation)
-                depths[next_expr] = next_depth
+                parents[next_key] = (current_key, transformation)
+                depths[next_key] = next_depth
 
-                ids[next_expr] = next_id
-                history.append((next_id, next_expr, None, transformation, ids[current_expr]))
+                ids[next_key] = next_id
+                history.append((next_id, next_key, None, transformation, ids[current_key]))
                 next_id += 1
 
                 if max_depth is None or next_depth < max_depth:
-                    stack.append(next_expr)
-
-                if next_expr == to_expr:
-                    path = [to_expr]
-                    actions = []
-                    current_expr = to_expr
-                    while current_expr is not None:
-                        (current_expr, action) = parents[current_expr]
-                        if current_expr is not None:
-                            path.insert(0, current_expr)
-                            actions.insert(0, action)
+                    stack.append(next_key)
 
+                if next_key == to_key:
+                    (path, actions) = reconstruct_path(parents, to_key, codec)
                     return (path, actions, history)
 
+
+def iterative_deepening_a_star(from_expr, to_expr, heuristics, weight=1.0,
+                               table_size=100000, codec=None, budget=None,
+                               stats=None, history=None):
+    """Iterative deepening A* search, using memory linear in the depth.
+
+    Depth-first searches are repeated with a growing bound on
+    `g + weight * h`, where `g` is the depth of a state and `h` its
+    estimated distance to the target. The next bound is the lowest value
+    exceeding the current one. The successors of each state are estimated
+    in a single call to the heuristics, and explored best first.
+
+    A transposition table of bounded size remembers the estimates of
+    recently seen states, and the depth at which they were last reached,
+    so that states reached again at no lesser depth during the same
+    iteration are not explored twice.
+
+    Since the history grows with the total work of all iterations, it is
+    only kept when a sink is given. Otherwise, the entries are counted in
+    a NullHistory.
+
+    Args:
+        from_expr: The source expression.
+        to_expr: The target expression.
+        heuristics: The heuristics, providing `with_target_batch`.
+        weight (float): Weight of the estimated distances.
+        table_size (int): Maximal number of entries of the
+            transposition table.
+        codec: Codec used to pack the states of the table, if any.
+        budget: If given, Budget limiting the resources of the search,
+            to which the visited states are those of the table.
+        stats: If given, SearchStats in which the search is measured,
+            including the number of `iterations`.
+        history: If given, sink receiving the history of the search,
+            such as those of `nugget.history`.
+
+    Returns:
+        The path of expressions from the source to the target,
+        the list of actions along it, and the history of the search,
+        None if the target could not be reached, or a BudgetExhausted
+        result if the budget ran out first.
+    """
+
+    if stats is not None:
+        stats.count('iterations', 0)
+
+    if from_expr == to_expr:
+        return ([from_expr], [], [])
+
+    (pack, _) = state_keys(codec, stats)
+    (expand_state, _, _) = successor_functions(stats)
+    h = estimator(heuristics.with_target_batch, to_expr, stats, budget)
+
+    from_state = Zipper.from_expr(from_expr)
+    from_key = pack(from_state)
+    to_key = pack(Zipper.from_expr(to_expr))
+
+    # Entries are the estimate of the state, the last iteration
+    # in which it was reached, and the depth at which it was.
+    table = LRUCache(table_size)
+
+    d = h([from_expr])[0]
+    bound = weight * d
+
+    # For logging purposes.
+    if history is None:
+        history = NullHistory()
+    history.append((0, from_key, d, None, None))
+    next_id = 1
+
+    iteration = 0
+    while bound is not None:
+        if stats is not None:
+            stats.count('iterations')
+
+        next_bound = None
+        table.put(from_key, (d, iteration, 0))
+
+        # The states along the current path, with the applied actions,
+        # and the states remaining to explore, deepest last.
+        path = []
+        on_path = set()
+        stack = [(from_state, from_key, 0, None, 0)]
+        while stack:
+            (current_state, current_key, current_depth, transformation, current_id) = stack.pop()
+            while len(path) > current_depth:
+                on_path.remove(path.pop()[0])
+            path.append((current_key, current_state, transformation))
+            on_path.add(current_key)
+
+            if current_key == to_key:
+                exprs = [s.to_expr() for (_, s, _) in path]
+                actions = [t for (_, _, t) in path[1:]]
+                return (exprs, actions, history)
+
+            if budget is not None and budget.step(len(table)):
+                return budget.result(history)
+
+            next_depth = current_depth + 1
+            children = []
+            (successors, _) = expand_state(current_state)
+            if stats is not None:
+                stats.count('expanded')
+                stats.count('generated', len(successors))
+            for (t, next_state) in successors:
+                next_key = pack(next_state)
+                if next_key in on_path:
+                    if stats is not None:
+                        stats.count('duplicates')
+                    continue
+                entry = table.get(next_key)
+                if entry is not None:
+                    (next_d, seen_iteration, seen_depth) = entry
+                    if seen_iteration == iteration and seen_depth <= next_depth:
+                        if stats is not None:
+                            stats.count('duplicates')
+                        continue
+                else:
+                    next_d = None
+                children.append((t, next_state, next_key, next_d))
+
+            missing = [i for (i, c) in enumerate(children) if c[3] is None]
+            if missing:
+                ds = h([children[i][1].to_expr() for i in missing])
+                for (i, next_d) in zip(missing, ds):
+                    (t, next_state, next_key, _) = children[i]
+                    children[i] = (t, next_state, next_key, next_d)
+
+            entries = []
+            for (t, next_state, next_key, next_d) in children:
+                f = next_depth + weight * next_d
+                if f > bound:
+                    # Only remembering the estimate, without losing the
+                    # depth at which the state was reached in this iteration.
+                    if next_key not in table:
+                        table.put(next_key, (next_d, None, None))
+                    if next_bound is None or f < next_bound:
+                        next_bound = f
+                    continue
+
+                table.put(next_key, (next_d, iteration, next_depth))
+                history.append((next_id, next_key, next_d, t, current_id))
+                entries.append((f, next_id, next_state, next_key, t))
+                next_id += 1
+
+            # Exploring the most promising successors first.
+            entries.sort(reverse=True)
+            for (_, entry_id, next_state, next_key, t) in entries:
+                stack.append((next_state, next_key, next_depth, t, entry_id))
+
+        bound = next_bound
+        iteration += 1
+
+    return None
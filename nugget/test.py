@@ -1,12 +1,18 @@
 import argparse
+import functools
 import gc
 import os
+import sys
 from timeit import default_timer
 
 from nugget.heuristics import *
+from nugget.history import NullHistory, open_history
+from nugget.inference import NumpyHeuristics
+from nugget.openlist import BucketOpenList, HeapOpenList
+from nugget.packed import Codec
 from nugget.reader import *
 from nugget.search import *
-from nugget.utils import timeout
+from nugget.utils import BatchSizeTuner, Budget, SearchStats
 
 DEFAULT_DATA = "data/testing.txt"
 DEFAULT_LOGS_DIR = "logs/"
@@ -28,6 +34,15 @@ if __name__ == "__main__":
         default=DEFAULT_LOGS_DIR)
     parser.add_argument("--no-logs", action="store_true",
         help="disable logging of search history")
+    parser.add_argument("--log-format", choices=["csv", "packed"],
+        help="format of the history logs",
+        default="csv")
+    parser.add_argument("--packed", action="store_true",
+        help="store the visited states in packed form")
+    parser.add_argument("--bidirectional", action="store_true",
+        help="use bidirectional search for BFS")
+    parser.add_argument("--bidirectional-nngs", action="store_true",
+        help="use bidirectional search for NNGS")
     parser.add_argument("-a", "--atoms", nargs="+", type=str,
         help="atoms",
         default=DEFAULT_ATOMS)
@@ -41,19 +56,124 @@ if __name__ == "__main__":
     parser.add_argument("--skip-nngs", help="disable NNGS", action="store_true")
     parser.add_argument("--skip-batch-nngs", help="disable Batch-NNGS", action="store_true")
     parser.add_argument("-s", "--size", help="embedding size", type=int)
+    parser.add_argument("--cache", type=int,
+        help="number of subexpression embeddings to cache")
+    parser.add_argument("--memoize", type=int,
+        help="number of heuristic estimates to remember across problems")
+    parser.add_argument("--memo-file", type=str,
+        help="file storing the remembered estimates between runs")
+    parser.add_argument("--batch-children", action="store_true",
+        help="estimate all successors of a state at once in NNGS")
+    parser.add_argument("--pipelined", action="store_true",
+        help="estimate batches in a background thread in Batch-NNGS")
+    parser.add_argument("--auto-batch", action="store_true",
+        help="choose the batch size of Batch-NNGS from measured latencies")
+    parser.add_argument("--max-latency", type=float,
+        help="maximal time in seconds to estimate a batch, with --auto-batch")
+    parser.add_argument("--buckets", type=float,
+        help="keep the open lists of NNGS in buckets of that width")
+    parser.add_argument("--lifo", action="store_true",
+        help="pop the most recent entry of a bucket first, with --buckets")
+    parser.add_argument("--numpy", action="store_true",
+        help="evaluate the network on CPU with NumPy for single queries")
     parser.add_argument("--device", type=int, help="GPU device")
-    parser.add_argument("--timeout", type=int, help="Timeout")
+    parser.add_argument("--timeout", type=float, help="Timeout")
+    parser.add_argument("--max-expansions", type=int,
+        help="maximal number of states expanded by each search")
+    parser.add_argument("--max-visited", type=int,
+        help="maximal number of states visited by each search")
+    parser.add_argument("--stats", type=str,
+        help="file to which the measurements of each search are written")
+    parser.add_argument("--stats-format", choices=["csv", "json"],
+        help="format of the measurements, with --stats",
+        default="csv")
     args = parser.parse_args()
 
-    h = Heuristics(args.atoms, args.model, args.size)
+    if args.numpy and args.bidirectional_nngs:
+        parser.error("--numpy does not support bidirectional NNGS")
+    if args.batch_children and args.bidirectional_nngs:
+        parser.error("--batch-children does not support bidirectional NNGS")
+    if args.buckets is not None and args.bidirectional_nngs:
+        parser.error("--buckets does not support bidirectional NNGS")
+
+    if args.numpy:
+        h = NumpyHeuristics(args.atoms, args.model, args.size, args.cache)
+    else:
+        h = Heuristics(args.atoms, args.model, args.size, args.cache)
     cuda = not args.no_cuda and torch.cuda.is_available()
     if cuda:
-        h_batch = Heuristics(args.atoms, args.model, args.size)
+        h_batch = Heuristics(args.atoms, args.model, args.size, args.cache)
         h_batch.cuda(args.device)
         # We do not send h to CUDA, much slower on single queries.
     else:
         h_batch = h
 
+    codec = Codec(args.atoms) if args.packed else None
+
+    if args.buckets is not None:
+        open_list = functools.partial(BucketOpenList, args.buckets,
+            lifo=args.lifo)
+    else:
+        open_list = HeapOpenList
+
+    if args.memoize is not None:
+        memoized = MemoizedHeuristics(h, args.memoize, args.memo_file, codec)
+        if h_batch is h:
+            h_batch = memoized
+        else:
+            h_batch = MemoizedHeuristics(h_batch, args.memoize, codec=codec)
+        h = memoized
+
+    if args.bidirectional:
+        bfs = bidirectional_breadth_first_search
+    else:
+        bfs = breadth_first_search
+
+    if args.bidirectional_nngs:
+        nngs = bidirectional_best_first_search
+    else:
+        nngs = functools.partial(best_first_search,
+            batch_children=args.batch_children, open_list=open_list)
+
+    if args.pipelined:
+        batch_nngs = pipelined_batch_best_first_search
+    else:
+        batch_nngs = batch_best_first_search
+
+    if args.auto_batch:
+        tuner = BatchSizeTuner(max_latency=args.max_latency)
+    else:
+        tuner = None
+
+    # Each search gets a fresh budget.
+    budget = functools.partial(Budget, args.timeout,
+        expansions=args.max_expansions, visited=args.max_visited)
+
+    if args.stats is not None:
+        statsFile = open(args.stats, 'w')
+        if args.stats_format == "csv":
+            statsFile.write(SearchStats.csv_header(["id", "search"]) + "\n")
+
+    def new_stats():
+        return SearchStats() if args.stats is not None else None
+
+    def write_stats(stats, i, search):
+        if stats is None:
+            return
+        if args.stats_format == "csv":
+            statsFile.write(stats.to_csv([i, search]) + "\n")
+        else:
+            statsFile.write(stats.to_json(id=i, search=search) + "\n")
+
+    # Histories are streamed to the logs during the searches.
+    log_codec = codec if codec is not None else Codec(args.atoms)
+
+    def new_history(i, search):
+        if args.no_logs:
+            return NullHistory()
+        return open_history(os.path.join(args.log_dir,
+            "{}-{}".format(i, search)), args.log_format, log_codec)
+
     reader = Reader(args.data)
 
     i = 0
@@ -77,27 +197,19 @@ if __name__ == "__main__":
         if not args.skip_bfs:
             gc.collect()
 
-            def exp0():
-                start_time = default_timer()
-                (p0, a0, h0) = breadth_first_search(a, b)
-                end_time = default_timer()
-                d0 = end_time - start_time
-                return (p0, a0, h0, d0)
-
-            if args.timeout is None:
-                (p0, a0, h0, d0) = exp0()
-                valid0 = True
-            else:
-                res0 = timeout(exp0, args.timeout)
-                valid0 = res0 is not None
-                if valid0:
-                    (p0, a0, h0, d0) = res0
-
-            if not args.no_logs and valid0:
-                outputFile = open(os.path.join(args.log_dir,
-                    "{}-bfs.csv".format(i)), 'w')
-                outputFile.write(history_to_csv(h0))
-                outputFile.close()
+            stats = new_stats()
+            history = new_history(i, "bfs")
+            start_time = default_timer()
+            res0 = bfs(a, b, codec=codec, budget=budget(), stats=stats,
+                history=history)
+            end_time = default_timer()
+            d0 = end_time - start_time
+            write_stats(stats, i, "bfs")
+            valid0 = bool(res0)
+            # Only the logs of the searches reaching the target are kept.
+            history.close(keep=valid0)
+            if valid0:
+                (p0, a0, h0) = res0
         else:
             valid0 = False
 
@@ -106,27 +218,18 @@ if __name__ == "__main__":
         if not args.skip_nngs:
             gc.collect()
 
-            def exp1():
-                start_time = default_timer()
-                (p1, a1, h1) = best_first_search(a, b, h, args.penalty)
-                end_time = default_timer()
-                d1 = end_time - start_time
-                return (p1, a1, h1, d1)
-
-            if args.timeout is None:
-                (p1, a1, h1, d1) = exp1()
-                valid1 = True
-            else:
-                res1 = timeout(exp1, args.timeout)
-                valid1 = res1 is not None
-                if valid1:
-                    (p1, a1, h1, d1) = res1
-
-            if not args.no_logs and valid1:
-                outputFile = open(os.path.join(args.log_dir,
-                    "{}-nngs.csv".format(i)), 'w')
-                outputFile.write(history_to_csv(h1))
-                outputFile.close()
+            stats = new_stats()
+            history = new_history(i, "nngs")
+            start_time = default_timer()
+            res1 = nngs(a, b, h, args.penalty,
+                codec=codec, budget=budget(), stats=stats, history=history)
+            end_time = default_timer()
+            d1 = end_time - start_time
+            write_stats(stats, i, "nngs")
+            valid1 = bool(res1)
+            history.close(keep=valid1)
+            if valid1:
+                (p1, a1, h1) = res1
         else:
             valid1 = False
 
@@ -135,28 +238,20 @@ if __name__ == "__main__":
         if not args.skip_batch_nngs:
             gc.collect()
 
-            def exp2():
-                start_time = default_timer()
-                (p2, a2, h2) = batch_best_first_search(a, b,
-                    h_batch, args.penalty, args.batch)
-                end_time = default_timer()
-                d2 = end_time - start_time
-                return (p2, a2, h2, d2)
-
-            if args.timeout is None:
-                (p2, a2, h2, d2) = exp2()
-                valid2 = True
-            else:
-                res2 = timeout(exp2, args.timeout)
-                valid2 = res2 is not None
-                if valid2:
-                    (p2, a2, h2, d2) = res2
-
-            if not args.no_logs and valid2:
-                outputFile = open(os.path.join(args.log_dir,
-                    "{}-batch-nngs.csv".format(i)), 'w')
-                outputFile.write(history_to_csv(h2))
-                outputFile.close()
+            stats = new_stats()
+            history = new_history(i, "batch-nngs")
+            start_time = default_timer()
+            res2 = batch_nngs(a, b,
+                h_batch, args.penalty, args.batch, codec=codec, tuner=tuner,
+                open_list=open_list, budget=budget(), stats=stats,
+                history=history)
+            end_time = default_timer()
+            d2 = end_time - start_time
+            write_stats(stats, i, "batch-nngs")
+            valid2 = bool(res2)
+            history.close(keep=valid2)
+            if valid2:
+                (p2, a2, h2) = res2
         else:
             valid2 = False
 
@@ -174,4 +269,17 @@ if __name__ == "__main__":
             str(len(h2)) if valid2 else "",
             str(d2) if valid2 else ""]))
 
-        i += 1
\ No newline at end of file
+        i += 1
+
+    if args.stats is not None:
+        statsFile.close()
+
+    if args.memoize is not None and args.memo_file is not None:
+        h.save()
+
+    if tuner is not None:
+        if tuner.chosen is not None:
+            sys.stderr.write("Chosen batch size: {}\n".format(tuner.chosen))
+        else:
+            sys.stderr.write("Batch size not chosen yet, last tried: {}\n"
+                .format(tuner.batch_size()))
\ No newline at end of file
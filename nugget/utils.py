@@ -1,7 +1,13 @@
+from collections import OrderedDict
+import json
+from timeit import default_timer
 
 def timeout(func, duration):
     """Timeout.
 
+    Only works in the main thread, and for whole seconds.
+    Searches are better bounded with a `Budget`.
+
     Adapted from StackOverflow:
     https://stackoverflow.com/questions/492519/timeout-on-a-function-call
     """
@@ -23,4 +29,337 @@ def timeout(func, duration):
     finally:
         signal.alarm(0)
 
-    return result
\ No newline at end of file
+    return result
+
+
+class Budget(object):
+    """Limits on the resources used by a search.
+
+    Searches check their budget between expansions, and stop as soon as
+    one of the counts reaches its limit, or once the budget is cancelled.
+    A budget keeps counting across searches, so that a fresh one is needed
+    for each search to be bounded independently.
+
+    Args:
+        seconds (float): Maximal wall time, from the creation of the budget.
+        expansions (int): Maximal number of expanded states.
+        heuristic_calls (int): Maximal number of calls to the heuristics.
+        visited (int): Maximal number of states remembered as visited.
+    """
+
+    def __init__(self, seconds=None, expansions=None, heuristic_calls=None,
+                 visited=None):
+        self.seconds = seconds
+        self.expansions = expansions
+        self.heuristic_calls = heuristic_calls
+        self.visited = visited
+        self.start_time = default_timer()
+        self.expanded = 0
+        self.calls = 0
+        self.largest_visited = 0
+        self.cancelled = False
+        self.reason = None
+
+    def cancel(self):
+        """Stop the searches using the budget, possibly from another thread."""
+        self.cancelled = True
+
+    def elapsed(self):
+        return default_timer() - self.start_time
+
+    def counted(self, h):
+        """Wrap a function estimating states, counting its calls."""
+
+        def apply(*args):
+            self.calls += 1
+            return h(*args)
+
+        return apply
+
+    def step(self, visited):
+        """Check the budget before expanding a state, and count it.
+
+        Args:
+            visited (int): Current number of visited states.
+
+        Returns:
+            bool: Whether the budget is exhausted, in which case
+            the state must not be expanded.
+        """
+
+        self.largest_visited = max(self.largest_visited, visited)
+        if self.cancelled:
+            self.reason = 'cancelled'
+        elif self.expansions is not None and self.expanded >= self.expansions:
+            self.reason = 'expansions'
+        elif (self.heuristic_calls is not None and
+                self.calls >= self.heuristic_calls):
+            self.reason = 'heuristic_calls'
+        elif self.visited is not None and visited >= self.visited:
+            self.reason = 'visited'
+        elif self.seconds is not None and self.elapsed() >= self.seconds:
+            self.reason = 'seconds'
+        else:
+            self.expanded += 1
+            return False
+        return True
+
+    def result(self, history):
+        """Return the result of a search stopped by the budget."""
+        return BudgetExhausted(self.reason, self.elapsed(), self.expanded,
+            self.calls, self.largest_visited, history)
+
+
+class BudgetExhausted(object):
+    """Result of a search stopped by its `Budget`.
+
+    Unlike found paths, such results are false.
+
+    Attributes:
+        reason (str): The limit which was reached: 'seconds', 'expansions',
+            'heuristic_calls', 'visited' or 'cancelled'.
+        elapsed (float): Wall time spent, in seconds.
+        expanded (int): Number of expanded states.
+        heuristic_calls (int): Number of calls to the heuristics.
+        visited (int): Largest number of visited states.
+        history: The history of the search so far.
+    """
+
+    def __init__(self, reason, elapsed, expanded, heuristic_calls, visited,
+                 history):
+        self.reason = reason
+        self.elapsed = elapsed
+        self.expanded = expanded
+        self.heuristic_calls = heuristic_calls
+        self.visited = visited
+        self.history = history
+
+    def __bool__(self):
+        return False
+
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        return ("BudgetExhausted(reason={!r}, elapsed={:.3f}, expanded={}, "
+                "heuristic_calls={}, visited={})").format(self.reason,
+            self.elapsed, self.expanded, self.heuristic_calls, self.visited)
+
+
+class SearchStats(object):
+    """Counters and per-phase timers of a search.
+
+    Searches given stats time their phases by wrapping the functions
+    involved, and only then, so that searches without stats are not slowed
+    down. Other counters, such as the `reopened` states of `focal_search`,
+    may be added by the searches.
+
+    The phases are the generation of `successors`, the `hashing` of states
+    to check whether they were visited, the calls to the `heuristics`,
+    and the operations on the `open_list`. Heuristics supporting stats also
+    record, within their calls, the time spent in `encoding` the expressions
+    as inputs of the network, and in evaluating the `model`.
+
+    Counters are accessed by name, as in ``stats['expanded']``.
+    """
+
+    phases = ['successors', 'hashing', 'heuristics', 'encoding', 'model',
+              'open_list']
+    counters = ['expanded', 'generated', 'duplicates', 'heuristic_calls',
+                'estimated', 'batches', 'batch_states', 'batch_capacity']
+
+    def __init__(self):
+        self.times = dict((phase, 0.0) for phase in self.phases)
+        self.counts = dict((counter, 0) for counter in self.counters)
+
+    def __getitem__(self, counter):
+        return self.counts[counter]
+
+    def count(self, counter, n=1):
+        self.counts[counter] = self.counts.get(counter, 0) + n
+
+    def add_time(self, phase, seconds):
+        self.times[phase] += seconds
+
+    def timed(self, phase, f):
+        """Wrap a function, adding the time spent in it to a phase."""
+
+        times = self.times
+
+        def apply(*args):
+            start_time = default_timer()
+            result = f(*args)
+            times[phase] += default_timer() - start_time
+            return result
+
+        return apply
+
+    def counted_heuristics(self, h):
+        """Wrap a function estimating states, counting its calls
+        and the states estimated."""
+
+        timed_h = self.timed('heuristics', h)
+        counts = self.counts
+
+        def apply(source, *args):
+            counts['heuristic_calls'] += 1
+            counts['estimated'] += (len(source)
+                if isinstance(source, (list, tuple)) else 1)
+            return timed_h(source, *args)
+
+        return apply
+
+    def batch(self, size, capacity):
+        """Record a batch of `size` states, out of at most `capacity`."""
+        self.counts['batches'] += 1
+        self.counts['batch_states'] += size
+        self.counts['batch_capacity'] += capacity
+
+    def batch_fill(self):
+        """Average fill ratio of the batches, or None without batches."""
+        if not self.counts['batch_capacity']:
+            return None
+        return self.counts['batch_states'] / self.counts['batch_capacity']
+
+    def to_dict(self):
+        """Return the counters, the times of the phases, suffixed
+        with ``_time``, and the batch fill ratio."""
+
+        record = dict(self.counts)
+        for (phase, seconds) in self.times.items():
+            record[phase + '_time'] = seconds
+        record['batch_fill'] = self.batch_fill()
+        return record
+
+    @classmethod
+    def csv_header(cls, prefix=()):
+        """Return the CSV header of `to_csv`, after the given columns."""
+        return ','.join(list(prefix) + cls.counters +
+            [phase + '_time' for phase in cls.phases] + ['batch_fill'])
+
+    def to_csv(self, prefix=()):
+        """Return a CSV line of the standard counters and of the times,
+        after the given values."""
+
+        record = self.to_dict()
+        columns = (self.counters +
+            [phase + '_time' for phase in self.phases] + ['batch_fill'])
+        return ','.join([str(v) for v in prefix] +
+            [str(record[c]) if record[c] is not None else ''
+             for c in columns])
+
+    def to_json(self, **extra):
+        """Return the record of `to_dict`, and the extra entries, in JSON."""
+
+        record = self.to_dict()
+        record.update(extra)
+        return json.dumps(record, sort_keys=True)
+
+
+class LRUCache(object):
+    """Dictionary of bounded size, evicting the least recently used entries.
+
+    Args:
+        capacity (int): Maximal number of entries.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        """Return the value of a key, and mark it as recently used.
+
+        Hits and misses are counted.
+        """
+
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.entries[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Insert or update an entry, evicting the oldest if needed."""
+
+        if key in self.entries:
+            del self.entries[key]
+        self.entries[key] = value
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+
+class BatchSizeTuner(object):
+    """Online choice of the batch size giving the best throughput.
+
+    Candidate sizes are tried in increasing order, each for a few batches,
+    while their average latency stays under the cap. The size which
+    estimated the most states per second is then chosen for good.
+
+    Args:
+        sizes: Candidate batch sizes, in increasing order.
+        max_latency (float): If given, maximal average time, in seconds,
+            taken to estimate a batch.
+        trials (int): Number of batches measured for each size.
+    """
+
+    def __init__(self, sizes=(16, 32, 64, 128, 256, 512, 1024),
+                 max_latency=None, trials=4):
+        self.sizes = list(sizes)
+        self.max_latency = max_latency
+        self.trials = trials
+        self.counts = [0] * len(self.sizes)
+        self.states = [0] * len(self.sizes)
+        self.times = [0.0] * len(self.sizes)
+        self.current = 0
+        self.chosen = None
+
+    def batch_size(self):
+        """Return the batch size to use for the next batch."""
+        if self.chosen is not None:
+            return self.chosen
+        return self.sizes[self.current]
+
+    def record(self, states, seconds):
+        """Record the time taken to estimate a batch of the current size."""
+
+        if self.chosen is not None:
+            return
+
+        i = self.current
+        self.counts[i] += 1
+        self.states[i] += states
+        self.times[i] += seconds
+        if self.counts[i] < self.trials:
+            return
+
+        if self.within_cap(i) and i + 1 < len(self.sizes):
+            self.current += 1
+            return
+
+        candidates = [j for j in range(i + 1) if self.within_cap(j)]
+        if not candidates:
+            candidates = [0]
+        best = max(candidates, key=self.throughput)
+        self.chosen = self.sizes[best]
+
+    def within_cap(self, i):
+        return (self.max_latency is None or
+                self.times[i] / self.counts[i] <= self.max_latency)
+
+    def throughput(self, i):
+        """Number of states estimated per second with the `i`-th size."""
+        return self.states[i] / max(self.times[i], 1e-9)
@@ -0,0 +1,346 @@
+# Copyright 2018 EPFL.
+
+import weakref
+
+from nugget.expressions import *
+
+# Bit of each transformation in applicability masks.
+UP_BIT = 1 << transformations.index(UP)
+LEFT_BIT = 1 << transformations.index(LEFT)
+RIGHT_BIT = 1 << transformations.index(RIGHT)
+ASSOC_LEFT_BIT = 1 << transformations.index(ASSOC_LEFT)
+ASSOC_RIGHT_BIT = 1 << transformations.index(ASSOC_RIGHT)
+COMMU_BIT = 1 << transformations.index(COMMU)
+DISTRI_TIMES_BIT = 1 << transformations.index(DISTRI_TIMES)
+DISTRI_PLUS_BIT = 1 << transformations.index(DISTRI_PLUS)
+
+rewrites_bits = [(1 << transformations.index(t), t, f) for (t, f) in rewrites]
+
+# Pairs of each rewrite rule and of the function undoing it.
+rewrites_inverses = [(t, dict(rewrites)[inverse_rewrites[t]])
+                     for (t, _) in rewrites]
+
+
+def expand(state):
+    """Apply all applicable transformations to a state at once.
+
+    Args:
+        state: A Zipper, or an expression containing a Focus.
+
+    Returns:
+        (list, int): The list of (transformation, successor) pairs,
+        in the order of `transformations`, and the applicability mask,
+        in which bit `i` is set if and only if `transformations[i]` applies.
+        Successors are of the same kind as the state.
+    """
+
+    if isinstance(state, Zipper):
+        return state.expand()
+
+    (successors, mask) = Zipper.from_expr(state).expand()
+    return ([(t, s.to_expr()) for (t, s) in successors], mask)
+
+
+def expand_backward(state):
+    """Find all predecessors of a state at once.
+
+    Args:
+        state: A Zipper, or an expression containing a Focus.
+
+    Returns:
+        list: The list of (transformation, predecessor) pairs such that
+        applying the transformation to the predecessor yields the state,
+        in the order of `transformations`.
+        Predecessors are of the same kind as the state.
+    """
+
+    if isinstance(state, Zipper):
+        return state.expand_backward()
+
+    predecessors = Zipper.from_expr(state).expand_backward()
+    return [(t, s.to_expr()) for (t, s) in predecessors]
+
+
+def applicable(state):
+    """Return the applicability mask of a state. See `expand`."""
+
+    if isinstance(state, Zipper):
+        return state.applicable()
+    return Zipper.from_expr(state).applicable()
+
+
+def mask_classifications(classes, mask):
+    """Mask the classifier outputs of inapplicable transformations.
+
+    Args:
+        classes: Scores of the transformations, as output by
+            `Net.classifications`, in the order of `transformations`.
+        mask: Applicability mask, as returned by `expand` or `applicable`.
+
+    Returns:
+        list: The scores, with those of inapplicable transformations
+        replaced by minus infinity.
+    """
+
+    return [c if mask & (1 << i) else float('-inf')
+            for (i, c) in enumerate(classes)]
+
+
+class Context(object):
+    """Path from a focused subexpression up to the root of the expression.
+
+    Each context records the binary node directly above the focus:
+    its operator, the side on which the focus lies (LEFT or RIGHT)
+    and the sibling subexpression. The parent context describes the rest
+    of the path, and is None at the root.
+
+    Like expressions, contexts are immutable and hash-consed.
+    """
+
+    __slots__ = ('operator', 'side', 'sibling', 'parent',
+                 '_hash', '_depth', '__weakref__')
+
+    _instances = weakref.WeakValueDictionary()
+
+    def __new__(cls, operator, side, sibling, parent):
+        key = (operator, side, sibling, parent)
+        self = cls._instances.get(key)
+        if self is None:
+            self = object.__new__(cls)
+            init = object.__setattr__
+            init(self, 'operator', operator)
+            init(self, 'side', side)
+            init(self, 'sibling', sibling)
+            init(self, 'parent', parent)
+            init(self, '_hash', hash(key))
+            init(self, '_depth',
+                1 + (parent._depth if parent is not None else 0))
+            self = cls._instances.setdefault(key, self)
+        return self
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Contexts are immutable.")
+
+    def __reduce__(self):
+        return (Context, (self.operator, self.side, self.sibling, self.parent))
+
+    def __eq__(self, that):
+        return self is that
+
+    def __ne__(self, that):
+        return self is not that
+
+    def __hash__(self):
+        return self._hash
+
+    def plug(self, expr):
+        """Rebuild the binary node above the focus around `expr`."""
+        if self.side == LEFT:
+            return Binary(self.operator, expr, self.sibling)
+        else:
+            return Binary(self.operator, self.sibling, expr)
+
+
+class Zipper(object):
+    """Expression with a focus, represented as a zipper.
+
+    Instead of a Focus node buried somewhere in the tree, a zipper holds
+    the focused subexpression (which contains no focus) and the context
+    leading from it to the root. The focus is thus found in constant time,
+    and transformations only rebuild the nodes they affect.
+
+    Zippers support the same transformation methods as expressions,
+    so that the functions of `transformations_functions` apply to both.
+
+    Args:
+        expr: The focused subexpression, without focus.
+        context: The context of the focus. None when at the root.
+    """
+
+    __slots__ = ('expr', 'context', '_hash')
+
+    def __init__(self, expr, context=None):
+        self.expr = expr
+        self.context = context
+        self._hash = hash((expr, context))
+
+    @classmethod
+    def from_expr(cls, expr):
+        """Convert an expression containing a Focus to a zipper."""
+
+        stack = [(expr, None)]
+        while stack:
+            (current, context) = stack.pop()
+            if current.is_focus():
+                return cls(current.expr, context)
+            if current.is_binary():
+                stack.append((current.rhs,
+                    Context(current.operator, RIGHT, current.lhs, context)))
+                stack.append((current.lhs,
+                    Context(current.operator, LEFT, current.rhs, context)))
+
+        raise ValueError("Expression without focus: {}".format(expr))
+
+    def to_expr(self):
+        """Convert the zipper back to an expression containing a Focus."""
+
+        expr = Focus(self.expr)
+        context = self.context
+        while context is not None:
+            expr = context.plug(expr)
+            context = context.parent
+        return expr
+
+    def __str__(self):
+        return str(self.to_expr())
+
+    def __repr__(self):
+        return str(self.to_expr())
+
+    def __lt__(self, other):
+        return False
+
+    def __eq__(self, that):
+        return (type(that) is Zipper and
+                self.expr is that.expr and
+                self.context is that.context)
+
+    def __ne__(self, that):
+        return not (self == that)
+
+    def __hash__(self):
+        return self._hash
+
+    def __getstate__(self):
+        return (self.expr, self.context)
+
+    def __setstate__(self, state):
+        (expr, context) = state
+        self.__init__(expr, context)
+
+    def depth(self):
+        """Depth of the focus in the expression."""
+        return self.context._depth if self.context is not None else 0
+
+    def move_focus_up(self):
+        context = self.context
+        if context is None:
+            return None
+
+        return Zipper(context.plug(self.expr), context.parent)
+
+    def move_focus_left(self):
+        expr = self.expr
+        if not expr.is_binary():
+            return None
+
+        return Zipper(expr.lhs,
+            Context(expr.operator, LEFT, expr.rhs, self.context))
+
+    def move_focus_right(self):
+        expr = self.expr
+        if not expr.is_binary():
+            return None
+
+        return Zipper(expr.rhs,
+            Context(expr.operator, RIGHT, expr.lhs, self.context))
+
+    def apply_commutativity(self):
+        expr = commutativity(self.expr)
+        return Zipper(expr, self.context) if expr is not None else None
+
+    def apply_associativity_left(self):
+        expr = associativity_left(self.expr)
+        return Zipper(expr, self.context) if expr is not None else None
+
+    def apply_associativity_right(self):
+        expr = associativity_right(self.expr)
+        return Zipper(expr, self.context) if expr is not None else None
+
+    def apply_distributivity_times(self):
+        expr = distributivity_times(self.expr)
+        return Zipper(expr, self.context) if expr is not None else None
+
+    def apply_distributivity_plus(self):
+        expr = distributivity_plus(self.expr)
+        return Zipper(expr, self.context) if expr is not None else None
+
+    def expand(self):
+        """Apply all applicable transformations at once. See `expand`."""
+
+        expr = self.expr
+        context = self.context
+        successors = []
+        mask = 0
+
+        if context is not None:
+            successors.append(
+                (UP, Zipper(context.plug(expr), context.parent)))
+            mask |= UP_BIT
+
+        if expr.is_binary():
+            successors.append((LEFT, Zipper(expr.lhs,
+                Context(expr.operator, LEFT, expr.rhs, context))))
+            successors.append((RIGHT, Zipper(expr.rhs,
+                Context(expr.operator, RIGHT, expr.lhs, context))))
+            mask |= LEFT_BIT | RIGHT_BIT
+
+            for (bit, t, rewrite) in rewrites_bits:
+                rewritten = rewrite(expr)
+                if rewritten is not None:
+                    successors.append((t, Zipper(rewritten, context)))
+                    mask |= bit
+
+        return (successors, mask)
+
+    def expand_backward(self):
+        """Find all predecessors at once. See `expand_backward`."""
+
+        expr = self.expr
+        context = self.context
+        predecessors = []
+
+        # Moving up from either child.
+        if expr.is_binary():
+            predecessors.append((UP, Zipper(expr.lhs,
+                Context(expr.operator, LEFT, expr.rhs, context))))
+            predecessors.append((UP, Zipper(expr.rhs,
+                Context(expr.operator, RIGHT, expr.lhs, context))))
+
+        # Moving down from the parent, on the side of the focus.
+        if context is not None:
+            predecessors.append((context.side,
+                Zipper(context.plug(expr), context.parent)))
+
+        for (t, inverse) in rewrites_inverses:
+            rewritten = inverse(expr)
+            if rewritten is not None:
+                predecessors.append((t, Zipper(rewritten, context)))
+
+        return predecessors
+
+    def applicable(self):
+        """Return the applicability mask, without building successors."""
+
+        expr = self.expr
+        mask = UP_BIT if self.context is not None else 0
+
+        if not expr.is_binary():
+            return mask
+
+        mask |= LEFT_BIT | RIGHT_BIT | COMMU_BIT
+        operator = expr.operator
+        lhs = expr.lhs
+        rhs = expr.rhs
+        if lhs.is_binary() and lhs.operator == operator:
+            mask |= ASSOC_LEFT_BIT
+        if rhs.is_binary() and rhs.operator == operator:
+            mask |= ASSOC_RIGHT_BIT
+        if operator == TIMES and rhs.is_binary() and rhs.operator == PLUS:
+            mask |= DISTRI_TIMES_BIT
+        if (operator == PLUS and
+                lhs.is_binary() and lhs.operator == TIMES and
+                rhs.is_binary() and rhs.operator == TIMES and
+                lhs.lhs == rhs.lhs):
+            mask |= DISTRI_PLUS_BIT
+        return mask
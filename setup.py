@@ -25,6 +25,7 @@ setup(
         "Tracker": 'https://github.com/epfl-lara/nugget/issues',
     },
     install_requires=[
+        "numpy",
         "torch>=0.3",
         "treenet>=0.0.2",
     ]
@@ -0,0 +1,101 @@
+# Copyright 2018 EPFL.
+
+import threading
+import time
+import unittest
+
+from nugget.expressions import from_prefix_notation, transformations
+from nugget.search import best_first_search, pipelined_batch_best_first_search
+from nugget.utils import Budget
+
+
+class StringHeuristics(object):
+    """Heuristics computed from the printed expressions.
+
+    Unlike those of the network, the estimates of an expression do not
+    depend on the other expressions estimated in the same call.
+    """
+
+    def with_target(self, target, stats=None):
+        target = str(target)
+
+        def estimate(expr):
+            string = str(expr)
+            distance = float(abs(len(string) - len(target)) +
+                             sum(a != b for (a, b) in zip(string, target)))
+            classes = [float(ord(c) * (i + 1) % 7)
+                       for (i, c) in enumerate(string[:len(transformations)])]
+            return (distance, classes)
+
+        def apply(source):
+            if not isinstance(source, (list, tuple)):
+                return estimate(source)
+            estimates = [estimate(expr) for expr in source]
+            return ([d for (d, _) in estimates], [c for (_, c) in estimates])
+
+        return apply
+
+
+class SlowHeuristics(StringHeuristics):
+    """String heuristics taking some time to estimate each batch."""
+
+    def __init__(self, delay=0.05):
+        self.delay = delay
+
+    def with_target_batch(self, target, stats=None):
+        apply = self.with_target(target, stats)
+
+        def estimate(exprs):
+            time.sleep(self.delay)
+            (ds, _) = apply(exprs)
+            return ds
+
+        return estimate
+
+
+class BatchChildrenTest(unittest.TestCase):
+
+    def test_same_history(self):
+        from_expr = from_prefix_notation("+ * C a + b c * c + a b")
+        to_expr = from_prefix_notation("+ C * b a + * a c * c + a b")
+        heuristics = StringHeuristics()
+
+        (path, actions, history) = best_first_search(
+            from_expr, to_expr, heuristics)
+        (batch_path, batch_actions, batch_history) = best_first_search(
+            from_expr, to_expr, heuristics, batch_children=True)
+
+        self.assertEqual(path[-1], to_expr)
+        self.assertGreater(len(history), 1000)
+        self.assertEqual(batch_path, path)
+        self.assertEqual(batch_actions, actions)
+        self.assertEqual(batch_history, history)
+
+
+class PipelinedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.from_expr = from_prefix_notation("+ * C a + b c * c + a b")
+        self.to_expr = from_prefix_notation("+ C * b a + * a c * c + a b")
+        self.threads = threading.active_count()
+
+    def test_found(self):
+        (path, _, _) = pipelined_batch_best_first_search(
+            self.from_expr, self.to_expr, SlowHeuristics(0.001),
+            batch_size=8, queue_size=4)
+
+        self.assertEqual(path[-1], self.to_expr)
+        self.assertEqual(threading.active_count(), self.threads)
+
+    def test_budget_exhausted(self):
+        result = pipelined_batch_best_first_search(
+            self.from_expr, self.to_expr, SlowHeuristics(),
+            batch_size=8, queue_size=4, budget=Budget(expansions=20))
+
+        self.assertFalse(result)
+        self.assertEqual(result.reason, 'expansions')
+        self.assertEqual(threading.active_count(), self.threads)
+
+
+if __name__ == "__main__":
+    unittest.main()